@@ -0,0 +1,93 @@
+import logging
+import math
+import random
+import time
+
+from fastapi import HTTPException
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """Take a token, return 0 if one was available or the seconds until the next token otherwise"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Token bucket rate limit plus a concurrency cap for one class of requests.
+
+    Only client traffic (connects and client socket handshakes) goes through admission control,
+    operator endpoints are never limited so they stay responsive while clients are rejected.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_concurrent: int, retry_after: float = 1.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def try_enter(self) -> float:
+        """Admit a request and return 0, or return a jittered retry hint in seconds if it is rejected"""
+        if self.in_flight >= self.max_concurrent:
+            wait = self.retry_after
+        else:
+            wait = self.bucket.try_acquire()
+        if not wait:
+            self.in_flight += 1
+            self.admitted += 1
+            return 0.0
+
+        self.rejected += 1
+        # Scale the hint with the current backlog and spread retries so that rejected clients don't return together
+        wait = max(wait, self.retry_after) * (1 + self.in_flight / max(self.max_concurrent, 1))
+        return wait * random.uniform(1, 2)
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "rate": self.bucket.rate,
+            "burst": self.bucket.burst,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+def admission_dependency(controller: AdmissionController):
+    """FastAPI dependency that rejects the request with 503 and a Retry-After header when not admitted"""
+
+    async def admit():
+        retry_after = controller.try_enter()
+        if retry_after:
+            logging.warning(f"Admission {controller.name} rejected request, retry after {retry_after:.1f} s")
+            raise HTTPException(
+                status_code=503, detail="errors.server_busy", headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+        try:
+            yield
+        finally:
+            controller.leave()
+
+    return admit
@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import time
@@ -6,9 +7,9 @@ from typing import Annotated, Awaitable, Optional
 from fastapi import APIRouter, Depends, HTTPException, WebSocket
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm  # , JWTAuthentication
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel
 
+from sessions import SessionRegistry
 from utils import WSMessage
 
 router = APIRouter()
@@ -95,20 +96,56 @@ users = {
 
 
 # Set up authentication
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+# Tokens carry a token ID (jti) so that they can be revoked before they expire
+sessions = SessionRegistry(JWT_EXPIRATION)
 # jwt_authentication = JWTAuthentication(secret=JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
-async def current_user(token: str = Depends(oauth2_scheme)):
+@functools.cache
+def pwd_context():
+    # passlib and bcrypt are only needed for operator logins, import them on first use
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def create_token(username: str, hostname: str | None = None) -> str:
+    issued_at = time.time()
+    expires_at = int(issued_at) + JWT_EXPIRATION
+    session = sessions.issue(username, hostname, issued_at, expires_at)
+    # iat is not rounded, a token issued right after its host was disconnected must be later than the cutoff
+    claims = {"sub": username, "exp": expires_at, "iat": issued_at, "jti": session.jti}
+    if hostname is not None:
+        claims["hostname"] = hostname
+    return jwt.encode(claims, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+def decode_token(token: str) -> dict:
+    """Return the claims of a valid, not revoked token"""
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="errors.invalid_auth_token")
-        return username
     except JWTError as e:
         raise HTTPException(status_code=401, detail="errors.invalid_auth_token") from e
+    if payload.get("sub") is None:
+        raise HTTPException(status_code=401, detail="errors.invalid_auth_token")
+    if sessions.is_revoked(payload.get("jti"), payload.get("hostname"), payload.get("iat", 0)):
+        raise HTTPException(status_code=401, detail="errors.token_revoked")
+    return payload
+
+
+async def current_user(token: str = Depends(oauth2_scheme)):
+    return decode_token(token)["sub"]
+
+
+async def admin_user(username: str = Depends(current_user)):
+    """
+    Allow only enabled white team (exercise control) users
+    """
+    user = users.get(username)
+    if user is None or user["disabled"] or user["team"] != "white":
+        raise HTTPException(status_code=403, detail="errors.forbidden")
+    return username
 
 
 class User(BaseModel):
@@ -134,7 +171,7 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     """
     # Verify username and password against the users from elasticsearch
     if not (
-        form_data.username in users and pwd_context.verify(form_data.password, users[form_data.username]["password"])
+        form_data.username in users and pwd_context().verify(form_data.password, users[form_data.username]["password"])
     ):
         logging.warning(f"Invalid login attempt from user {form_data.username}")
         raise HTTPException(status_code=401, detail="errors.invalid_username_or_password")
@@ -143,11 +180,7 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     current_user = users[form_data.username]
 
     # Generate JWT token
-    token = jwt.encode(
-        {"sub": current_user["username"], "exp": int(time.time()) + JWT_EXPIRATION},
-        JWT_SECRET,
-        algorithm=JWT_ALGORITHM,
-    )
+    token = create_token(current_user["username"])
 
     return {"access_token": token, "token_type": "bearer", "user": current_user}
 
@@ -0,0 +1,127 @@
+import itertools
+import logging
+import time
+from collections import deque
+from enum import Enum
+
+
+class BehaviourState(str, Enum):
+    QUEUED = "queued"
+    SENT = "sent"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+
+ACTIVE_STATES = {BehaviourState.QUEUED, BehaviourState.SENT, BehaviourState.RUNNING}
+
+# Allowed transitions, clients may report finished/failed without reporting running first
+TRANSITIONS = {
+    BehaviourState.QUEUED: {BehaviourState.SENT, BehaviourState.RUNNING, BehaviourState.FAILED},
+    BehaviourState.SENT: {BehaviourState.RUNNING, BehaviourState.FINISHED, BehaviourState.FAILED},
+    BehaviourState.RUNNING: {BehaviourState.FINISHED, BehaviourState.FAILED},
+    BehaviourState.FINISHED: set(),
+    BehaviourState.FAILED: set(),
+}
+
+
+class BehaviourRun:
+    __slots__ = ("run_id", "client", "behaviour_id", "state", "timestamps", "detail")
+
+    def __init__(self, run_id: int, client: str, behaviour_id: str):
+        self.run_id = run_id
+        self.client = client
+        self.behaviour_id = behaviour_id
+        self.state = BehaviourState.QUEUED
+        self.timestamps = {BehaviourState.QUEUED.value: time.time()}
+        self.detail: str | None = None
+
+    def dict(self) -> dict:
+        return {
+            "run_id": self.run_id,
+            "client": self.client,
+            "behaviour_id": self.behaviour_id,
+            "state": self.state.value,
+            "timestamps": dict(self.timestamps),
+            "detail": self.detail,
+        }
+
+
+class BehaviourTracker:
+    """
+    Behaviour state machine per client (queued -> sent -> running -> finished/failed).
+
+    Keeps the latest run per client, a bounded history ring per client and an inverted index
+    behaviour -> state -> clients, so "who is running X" is answered without scanning all clients.
+    """
+
+    def __init__(self, history_size: int = 50):
+        self.history_size = history_size
+        self.current: dict[str, BehaviourRun] = {}
+        self.history: dict[str, deque[BehaviourRun]] = {}
+        self.index: dict[str, dict[BehaviourState, set[str]]] = {}
+        self._run_ids = itertools.count(1)
+
+    def _index_add(self, run: BehaviourRun):
+        self.index.setdefault(run.behaviour_id, {}).setdefault(run.state, set()).add(run.client)
+
+    def _index_remove(self, run: BehaviourRun):
+        clients = self.index.get(run.behaviour_id, {}).get(run.state)
+        if clients is not None:
+            clients.discard(run.client)
+            if not clients:
+                del self.index[run.behaviour_id][run.state]
+
+    def queue(self, client: str, behaviour_id: str) -> BehaviourRun:
+        """Start tracking a dispatched behaviour, an unfinished previous run of the client is marked failed"""
+        previous = self.current.get(client)
+        if previous is not None and previous.state in ACTIVE_STATES:
+            self.transition(client, BehaviourState.FAILED, detail=f"superseded by {behaviour_id}")
+        if previous is not None:
+            self._index_remove(previous)
+
+        run = BehaviourRun(next(self._run_ids), client, behaviour_id)
+        self.current[client] = run
+        self.history.setdefault(client, deque(maxlen=self.history_size)).append(run)
+        self._index_add(run)
+        return run
+
+    def transition(
+        self,
+        client: str,
+        state: BehaviourState,
+        behaviour_id: str | None = None,
+        run_id: int | None = None,
+        detail: str | None = None,
+    ) -> bool:
+        """Move the client's current run to state, returns False if there is no matching run or the move is invalid"""
+        run = self.current.get(client)
+        if run is None or (behaviour_id and run.behaviour_id != behaviour_id) or (run_id and run.run_id != run_id):
+            return False
+        if state == run.state:
+            return False
+        if state not in TRANSITIONS[run.state]:
+            logging.warning(f"Invalid behaviour state change {run.state.value} -> {state.value} for client {client}")
+            return False
+
+        self._index_remove(run)
+        run.state = state
+        run.timestamps[state.value] = time.time()
+        run.detail = detail or run.detail
+        self._index_add(run)
+        return True
+
+    def current_behaviour(self, client: str) -> str | None:
+        run = self.current.get(client)
+        return run.behaviour_id if run is not None and run.state in ACTIVE_STATES else None
+
+    def clients(self, behaviour_id: str, states: set[BehaviourState] | None = None) -> list[str]:
+        """Clients whose latest run of behaviour_id is in one of the states (active states by default)"""
+        by_state = self.index.get(behaviour_id, {})
+        result = []
+        for state in states or ACTIVE_STATES:
+            result.extend(by_state.get(state, ()))
+        return result
+
+    def client_history(self, client: str) -> list[dict]:
+        return [run.dict() for run in self.history.get(client, ())]
@@ -0,0 +1,326 @@
+"""
+Micro-benchmarks for the server's hot functions.
+
+Run from the repository root (the server modules read config.ini and the YAML files from there):
+
+    python -m benchmarks.bench                       # run all cases and print results
+    python -m benchmarks.bench --save baseline       # run and store results as benchmarks/baselines/baseline.json
+    python -m benchmarks.bench --compare baseline    # run and compare against a stored baseline
+    python -m benchmarks.bench --filter i18n         # run only cases whose name contains "i18n"
+"""
+
+import argparse
+import asyncio
+import atexit
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from typing import Callable
+
+cwd = os.path.abspath(os.path.dirname(__file__))
+baselines_dir = os.path.join(cwd, "baselines")
+
+# Cases are registered as (name, setup) where setup() returns the zero-argument callable to time
+CASES: list[tuple[str, Callable[[], Callable[[], object]]]] = []
+
+
+def case(name: str):
+    def decorator(setup):
+        CASES.append((name, setup))
+        return setup
+
+    return decorator
+
+
+def run_async(coro_func: Callable, *args) -> Callable[[], object]:
+    """Wrap a coroutine function so that it can be timed like a plain function"""
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(coro_func(*args))
+
+
+def build_generator_template(behaviours: int, params: int) -> dict:
+    template = {"conversation_starter_frequency": 2, "automation": {"idle_cycle": {}, "behaviours": {}}}
+    template["automation"]["idle_cycle"]["procrastination_chance"] = {"min": 0, "max": 1}
+    for b in range(behaviours):
+        behaviour = {}
+        for p in range(params):
+            if p % 3 == 0:
+                behaviour[f"param_{p}"] = {"min": 1, "max": 100}
+            elif p % 3 == 1:
+                behaviour[f"param_{p}"] = {"nested": {"min": 0, "max": 1}, "values": [1, {"min": 5, "max": 10}]}
+            else:
+                behaviour[f"param_{p}"] = f"value_{p}"
+        template["automation"]["behaviours"][f"behaviour_{b}"] = behaviour
+    return template
+
+
+def build_translation_payload(clients: int) -> dict:
+    return {
+        "detail": "errors.invalid_auth_token",
+        "clients_info": [
+            {
+                "username": f"user{i}@corp.sk",
+                "hostname": f"host-{i}",
+                "current_behaviour": None,
+                "status": {"en": "Running", "sk": "Beží"},
+                "errors": ["errors.forbidden", "errors.invalid_hostname"],
+                "client_config": {
+                    "automation": {
+                        "idle_cycle": {"procrastination_chance": 0.5},
+                        "behaviours": {"procrastination": {"duration_min": 60, "duration_max": 80}},
+                    }
+                },
+            }
+            for i in range(clients)
+        ],
+    }
+
+
+for behaviours, params in [(1, 4), (10, 10), (50, 20)]:
+
+    @case(f"config_generator.generate_config[{behaviours}x{params}]")
+    def _setup_generate_config(behaviours=behaviours, params=params):
+        from config_generator import ConfigGenerator
+
+        generator = ConfigGenerator(build_generator_template(behaviours, params))
+        return lambda: generator.generate_config("user@corp.sk")
+
+    @case(f"memory.ConfigInterner.intern[{behaviours}x{params}]")
+    def _setup_intern_config(behaviours=behaviours, params=params):
+        from config_generator import ConfigGenerator
+        from memory import ConfigInterner
+
+        client_config = ConfigGenerator(build_generator_template(behaviours, params)).generate_config("user@corp.sk")
+        interner = ConfigInterner()
+        return lambda: interner.intern(client_config)
+
+
+for clients in [10, 1000]:
+
+    @case(f"i18n.translate[{clients} clients]")
+    def _setup_translate(clients=clients):
+        from i18n import translate
+
+        payload = build_translation_payload(clients)
+        return lambda: translate(payload, "sk")
+
+    @case(f"i18n.translate_response[{clients} clients]")
+    def _setup_translate_response(clients=clients):
+        from i18n import translate_response
+
+        body = json.dumps(build_translation_payload(clients)).encode("utf-8")
+        return lambda: translate_response(body, "sk")
+
+
+BEHAVIOUR_CONFIGS = {
+    "attack_phishing": {"malicious_email_subject": "Invoice overdue"},
+    "attack_phishing_attachment": {"malicious_email_subject": "Invoice overdue"},
+    "attack_ransomware": {"encryption_key": "0123456789abcdef", "ransom_message": "Pay up", "delay_seconds": 10},
+    "attack_reverse_shell": {"target_host": "10.0.0.1", "target_port": 4444},
+    "procrastination": {"websites": ["youtube.com"], "visit_duration_minutes": 5},
+    "work_emails": {"email_accounts": ["a@corp.sk", "b@corp.sk"], "auto_reply": True},
+    "work_organization_web": {"websites": ["intranet.corp.sk"]},
+}
+
+for behaviour_id, behaviour_config in BEHAVIOUR_CONFIGS.items():
+
+    @case(f"client_behaviour.validate_behavior_config[{behaviour_id}]")
+    def _setup_validate(behaviour_id=behaviour_id, behaviour_config=behaviour_config):
+        from client_behaviour import AvailableBehaviors, _validate_canonical_config, validate_behavior_config
+
+        behaviour = AvailableBehaviors(behaviour_id)
+
+        def validate():
+            # Every call validates, comparable with baselines saved before validation results were cached
+            _validate_canonical_config.cache_clear()
+            return validate_behavior_config(behaviour, behaviour_config)
+
+        return validate
+
+    @case(f"client_behaviour.validate_behavior_config[{behaviour_id}, cached]")
+    def _setup_validate_cached(behaviour_id=behaviour_id, behaviour_config=behaviour_config):
+        from client_behaviour import AvailableBehaviors, validate_behavior_config
+
+        behaviour = AvailableBehaviors(behaviour_id)
+        return lambda: validate_behavior_config(behaviour, behaviour_config)
+
+
+class NullWebSocket:
+    """Stand-in for a starlette WebSocket that discards everything sent to it"""
+
+    async def send_text(self, data: str):
+        pass
+
+    async def send_bytes(self, data: bytes):
+        pass
+
+    async def send_json(self, data):
+        json.dumps(data)
+
+
+for size in [1, 100]:
+
+    @case(f"sockets.SocketManager._send_message[{size} behaviours]")
+    def _setup_send_message(size=size):
+        from fastapi import APIRouter
+
+        from config_generator import ConfigGenerator
+        from sockets import SocketManager
+
+        manager = SocketManager(APIRouter(), "/bench_socket", True)
+        message = ConfigGenerator(build_generator_template(size, 10)).generate_config("user@corp.sk")
+        return run_async(manager._send_message, message, NullWebSocket())
+
+    @case(f"sockets.SocketManager._send_message[{size} behaviours, msgpack]")
+    def _setup_send_message_binary(size=size):
+        from fastapi import APIRouter
+
+        from config_generator import ConfigGenerator
+        from sockets import SocketManager
+
+        manager = SocketManager(APIRouter(), "/bench_socket", True)
+        websocket = NullWebSocket()
+        manager.binary_sockets.add(websocket)
+        message = ConfigGenerator(build_generator_template(size, 10)).generate_config("user@corp.sk")
+        return run_async(manager._send_message, message, websocket)
+
+
+@case("hostname.is_valid_hostname[mixed]")
+def _setup_is_valid_hostname():
+    from hostname import is_valid_hostname
+
+    hostnames = ["ws-001", "ws-001.corp.example.sk", "-invalid", "a" * 64, "x" * 250, "host_name", "10.0.0.1"]
+    return lambda: [is_valid_hostname(hostname) for hostname in hostnames]
+
+
+@functools.cache
+def credentials_file(lines: int) -> str:
+    handle, path = tempfile.mkstemp(suffix=".yml")
+    with os.fdopen(handle, "w") as f:
+        for key in ["o365_credentials", "domain_credentials"]:
+            f.write(f"{key}:\n")
+            for i in range(lines // 2):
+                f.write(f"  - user{i}@corp.sk:{{plain}}Password{i}!\n")
+    atexit.register(os.remove, path)
+    return path
+
+
+@case("parse_credentials.parse_user_credentials[10k lines]")
+def _setup_parse_user_credentials():
+    from parse_credentials import parse_user_credentials
+
+    path = credentials_file(10000)
+    return lambda: parse_user_credentials(path)
+
+
+@case("parse_credentials.CredentialStore.load[10k lines]")
+def _setup_credential_store_load():
+    from parse_credentials import CredentialStore
+
+    store = CredentialStore(credentials_file(10000))
+    return store.load
+
+
+@case("auth.current_user[valid token]")
+def _setup_current_user():
+    from jose import jwt
+
+    from auth import JWT_ALGORITHM, JWT_SECRET, current_user
+
+    token = jwt.encode(
+        {"sub": "user@corp.sk", "hostname": "ws-001", "exp": int(time.time()) + 3600}, JWT_SECRET, JWT_ALGORITHM
+    )
+    return run_async(current_user, token)
+
+
+def measure(func: Callable[[], object], repeat: int, min_time: float) -> dict:
+    """Time func and return per-call statistics in microseconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    timings = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "number": number,
+        "min_us": min(timings),
+        "median_us": statistics.median(timings),
+        "stdev_us": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def run(name_filter: str | None, repeat: int, min_time: float) -> dict:
+    results = {}
+    for name, setup in CASES:
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(setup(), repeat, min_time)
+        print(f"{name:<70} {results[name]['min_us']:>12.2f} us  (median {results[name]['median_us']:.2f} us)")
+    return results
+
+
+def baseline_path(name: str) -> str:
+    return os.path.join(baselines_dir, f"{name}.json")
+
+
+def save_baseline(name: str, results: dict):
+    os.makedirs(baselines_dir, exist_ok=True)
+    data = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(baseline_path(name), "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    print(f"Saved baseline '{name}' to {baseline_path(name)}")
+
+
+def compare(name: str, results: dict, threshold: float) -> bool:
+    """Print a comparison report against a stored baseline, return False if any case regressed"""
+    with open(baseline_path(name), "r") as f:
+        baseline = json.load(f)["results"]
+
+    ok = True
+    print(f"\nComparison against baseline '{name}' (regression threshold {threshold:.0%})")
+    print(f"{'case':<70} {'baseline us':>12} {'current us':>12} {'change':>9}")
+    for case_name, result in results.items():
+        if case_name not in baseline:
+            print(f"{case_name:<70} {'-':>12} {result['min_us']:>12.2f} {'new':>9}")
+            continue
+        before = baseline[case_name]["min_us"]
+        change = result["min_us"] / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        elif change < -threshold:
+            flag = "  improved"
+        print(f"{case_name:<70} {before:>12.2f} {result['min_us']:>12.2f} {change:>+9.1%}{flag}")
+    return ok
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks for the server's hot functions")
+    parser.add_argument("--filter", help="only run cases whose name contains this string")
+    parser.add_argument("--save", metavar="NAME", help="store results as a named baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare results against a named baseline")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timing repetitions per case")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per repetition")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.repeat, args.min_time)
+    if args.save:
+        save_baseline(args.save, results)
+    if args.compare:
+        return 0 if compare(args.compare, results, args.threshold) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,45 @@
-import configparser
+import asyncio
+import json
 import logging
 import os
+import random
+import sys
+import tempfile
 import time
+from datetime import datetime
 from typing import Annotated
 
-import yaml
-from fastapi import APIRouter, Depends, Form, HTTPException
+import httpx
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from jose import jwt
 from pydantic import BaseModel
 
 # from auth import current_user
-from config_generator import ConfigGenerator
+from admission import AdmissionController, admission_dependency
+from auth import admin_user, create_token, sessions
+from behaviour_tracker import BehaviourState, BehaviourTracker
+from cluster import cluster
+from compute import compute_pool
+from config_generator import ConfigGenerator, generate_configs, sample_configs
+from config_pool import ConfigPool
+from config_sync import ConfigSync, config_version
 from hostname import is_valid_hostname
+from inbound import InboundPipeline, per_message
+from journal import EventJournal
+from memory import ConfigInterner, deep_sizeof
 from models.client_config import ClientConfig
-from parse_credentials import parse_user_credentials
+from models.client_info import ClientInfo, ClientsInfoResponse, encode_clients_info
+from parse_credentials import CredentialStore, parse_credentials_index, parse_user_credentials
+from profiler import profiler, task_snapshot
 from sockets import SocketManager
+from startup import drop_cached, load_cached, load_config, phase
 
 # Load configuration from environment variables or a file
-JWT_SECRET = os.getenv("JWT_SECRET", "ExgEFKuRnzSZhjAq")
-JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 JWT_EXPIRATION = int(os.getenv("JWT_EXPIRATION", 36000))  # seconds
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-
-class ClientInfo(BaseModel):
-    username: str
-    hostname: str
-    current_behaviour: str | None
-    client_config: ClientConfig
+config = load_config()
 
 
 class OAuth2PasswordRequestFormWithHostname(OAuth2PasswordRequestForm):
@@ -40,6 +49,7 @@ class OAuth2PasswordRequestFormWithHostname(OAuth2PasswordRequestForm):
         username: Annotated[str, Form()],
         password: Annotated[str, Form()],
         hostname: Annotated[str, Form()],
+        config_version: Annotated[str | None, Form()] = None,
     ):
         super().__init__(
             username=username,
@@ -49,6 +59,7 @@ class OAuth2PasswordRequestFormWithHostname(OAuth2PasswordRequestForm):
             client_secret=None,
         )
         self.hostname = hostname
+        self.config_version = config_version
 
 
 cwd = os.path.abspath(os.path.dirname(__file__))
@@ -56,56 +67,307 @@ config_file = os.path.join(cwd, "config.yml")
 user_credentials_file = os.path.join(cwd, "user_credentials.yml")
 config_generation_file = os.path.join(cwd, "config_generator.yml")
 
-user_credentials = parse_user_credentials(user_credentials_file)
-
+credential_store = CredentialStore(user_credentials_file)
+with phase("user_credentials.yml"):
+    credential_store.load()
+# Earlier versions pickled the passwords into the startup cache
+drop_cached(user_credentials_file, parse_credentials_index, parse_user_credentials)
 
 if config.getboolean("DEFAULT", "use_o365"):
-    credentials = user_credentials.get("o365_credentials", [])
+    credentials_key = "o365_credentials"
 else:
-    credentials = user_credentials.get("domain_credentials", [])
+    credentials_key = "domain_credentials"
+
+state_file = os.path.join(cwd, config.get("drain", "state_file", fallback="clients_state.json"))
+if cluster.enabled:
+    # Instances started from the same directory keep their own state and journal
+    state_file = f"{os.path.splitext(state_file)[0]}-{cluster.name}.json"
+
+
+def save_clients_state(path: str):
+    """Write clients_info to the state file, so that a restarted or second instance can take over the clients"""
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, "w") as f:
+        json.dump(
+            {
+                "saved_at": time.time(),
+                "clients_info": clients_info,
+                "revoked_sessions": sessions.revoked,
+                "hostname_not_before": sessions.not_before,
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
+
+
+# Identical parts of generated configs are shared between clients
+config_interner = ConfigInterner(config.getint("memory", "interned_configs", fallback=10000))
+
+
+def client_info_entry(username: str, hostname: str, client_config: dict, interned: bool = False) -> dict:
+    return {
+        "username": sys.intern(username),
+        "current_behaviour": None,
+        "client_config": client_config if interned else config_interner.intern(client_config),
+        "hostname": sys.intern(hostname),
+    }
+
+
+def load_clients_state(path: str) -> dict:
+    """Read clients_info saved by a drained instance, states older than the token lifetime are ignored"""
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as ex:
+        logging.warning(f"Cannot read clients state {path}: {ex}")
+        return {}
+    if time.time() - state.get("saved_at", 0) > JWT_EXPIRATION:
+        return {}
+    # Revoked tokens and disconnected hosts stay revoked on the next instance
+    for jti, expires_at in state.get("revoked_sessions", {}).items():
+        sessions.revoke(jti, expires_at)
+    for hostname, cutoff in state.get("hostname_not_before", {}).items():
+        sessions.revoke_hostname(hostname, cutoff)
+    return {
+        sys.intern(hostname): client_info_entry(client["username"], hostname, client["client_config"])
+        for hostname, client in state.get("clients_info", {}).items()
+    }
+
+
+def take_over_clients_state(path: str) -> int:
+    """
+    Add the clients saved by a drained instance to clients_info and remove the state file, so that the clients are
+    taken over once and a later restart does not load them again. Clients connected meanwhile are kept.
+    Returns the number of clients taken over.
+    """
+    claimed = f"{path}.{os.getpid()}"
+    try:
+        # Claim the file first, it is written by an atomic replace so it is never read half written
+        os.replace(path, claimed)
+    except FileNotFoundError:
+        return 0
+    try:
+        loaded = load_clients_state(claimed)
+    finally:
+        os.remove(claimed)
+    for hostname, client in loaded.items():
+        clients_info.setdefault(hostname, client)
+    return len(loaded)
 
-available_client_users = {user["username"]: user for user in credentials}
 
 clients_info: dict[str, ClientInfo] = {}
+draining = False
+state_poll_interval = config.getfloat("drain", "state_poll_interval", fallback=0.5)
+
 
-config_generator = None
+async def watch_clients_state():
+    """Take over the clients of an instance draining on the same port (see serve.py) as soon as it saved them"""
+    while True:
+        await asyncio.sleep(state_poll_interval)
+        if not draining and os.path.exists(state_file):
+            count = take_over_clients_state(state_file)
+            logging.info(f"Took over {count} clients from {state_file}")
 
-with open(config_generation_file, "r") as stream:
-    config_generator = ConfigGenerator(yaml.safe_load(stream).get("config_generation", {}))
+
+journal = EventJournal(
+    os.path.join(cwd, config.get("journal", "directory", fallback="journal"), cluster.name if cluster.enabled else ""),
+    max_bytes=config.getint("journal", "max_bytes", fallback=64 * 1024 * 1024),
+    max_files=config.getint("journal", "max_files", fallback=0),
+    queue_size=config.getint("journal", "queue_size", fallback=100000),
+)
+
+config_generator = ConfigGenerator(load_cached(config_generation_file).get("config_generation", {}))
+# The conversation starter state is only changed on the event loop and never across an await, bulk generation
+# reserves the conversation slots of its clients before it is offloaded to a compute worker
+template_version = config_version(config_generator.generator_config)
+
+
+async def sample_pool_configs(count: int) -> list[dict]:
+    """Sample and intern configs for the pool, so that connects taking them do not pay for interning"""
+    configs = await compute_pool.run(
+        "generate_configs", count, sample_configs, config_generator.generator_config, count
+    )
+    start = time.perf_counter()
+    configs = [config_interner.intern(config) for config in configs]
+    config_pool.intern_seconds += time.perf_counter() - start
+    return configs
+
+
+config_pool = ConfigPool(
+    size=config.getint("config_pool", "size", fallback=200),
+    refill_below=config.getint("config_pool", "refill_below", fallback=100),
+)
+config_pool.set_template(template_version, sample_pool_configs)
 
 router = APIRouter()
 
 
-async def send_client_status(websocket):
+async def send_client_status(websocket, username):
     """Send client status updates to websocket"""
+    journal.record("socket_connect", username, endpoint="client_status_socket")
     # Implement your status sending logic here
-    pass
 
 
-async def update_client_status(data, websocket):
-    """Update client status"""
-    # Implement your status update logic here
-    pass
+async def client_status_socket_closed(websocket, username):
+    journal.record("socket_disconnect", username, endpoint="client_status_socket")
+
+
+async def update_client_status(data, websocket, username):
+    """
+    Update client behaviour state from a client report like
+    {"behaviour_id": "procrastination", "run_id": 3, "state": "running", "detail": null}
+    """
+    apply_client_status(data, username)
+
+
+async def update_client_statuses(batch):
+    """Apply a batch of status reports from the inbound pipeline without yielding to the event loop"""
+    for data, websocket, username in batch:
+        apply_client_status(data, username)
+
+
+def apply_client_status(data, username):
+    if not isinstance(data, dict) or "state" not in data:
+        return
+    try:
+        state = BehaviourState(data["state"])
+    except ValueError:
+        logging.warning(f"Client {username} reported unknown behaviour state {data['state']}")
+        return
+    accepted = behaviour_tracker.transition(
+        username, state, data.get("behaviour_id"), data.get("run_id"), data.get("detail")
+    )
+    journal.record(
+        "behaviour_state",
+        username,
+        behaviour_id=data.get("behaviour_id"),
+        run_id=data.get("run_id"),
+        state=state.value,
+        detail=data.get("detail"),
+        accepted=accepted,
+    )
+
+
+behaviour_tracker = BehaviourTracker(config.getint("tracking", "history_size", fallback=50))
 
 
 async def send_client_config(websocket, username):
     """Send client config to websocket"""
+    journal.record("socket_connect", username, endpoint="client_socket")
+
 
-    pass
+async def client_socket_closed(websocket, username):
+    journal.record("socket_disconnect", username, endpoint="client_socket")
 
 
 async def update_client_config(data, websocket, username):
-    """Update client config"""
-    # Implement your config update logic here
-    pass
+    """Handle behaviour config acknowledgements and version mismatch reports"""
+    if not isinstance(data, dict):
+        return
+    action = data.get("action")
+    if action in ("config_ack", "config_version_mismatch"):
+        journal.record(action, username, behaviour_id=data.get("behaviour_id"), version=data.get("version"))
+    client = client_sockets.client_id(websocket) or username
+    if action == "config_ack":
+        if not config_sync.acknowledge(client, data.get("behaviour_id"), data.get("version")):
+            logging.info(f"Client {username} acknowledged outdated {data.get('behaviour_id')} config")
+    elif action == "config_version_mismatch":
+        message = config_sync.full_message(client, data.get("behaviour_id"))
+        if message is None:
+            logging.info(f"Client {username} reported a version of {data.get('behaviour_id')} config it was never sent")
+            return
+        logging.info(
+            f"Client {username} has {data.get('behaviour_id')} config version {data.get('version')}, resyncing"
+        )
+        client_sockets.queue_json(websocket, message)
 
 
-client_status_sockets = SocketManager(router, "/client_status_socket", True, send_client_status, update_client_status)
-client_sockets = SocketManager(router, "/client_socket", True, send_client_config, update_client_config)
+async def acknowledge_client_configs(batch):
+    """Apply a batch of config acknowledgements from the inbound pipeline"""
+    outdated = 0
+    for data, websocket, username in batch:
+        journal.record("config_ack", username, behaviour_id=data.get("behaviour_id"), version=data.get("version"))
+        client = client_sockets.client_id(websocket) or username
+        if not config_sync.acknowledge(client, data.get("behaviour_id"), data.get("version")):
+            outdated += 1
+    if outdated:
+        logging.info(f"{outdated} of {len(batch)} config acknowledgements were for outdated configs")
 
 
-class ClientsInfoResponse(BaseModel):
-    clients_info: list[ClientInfo]
+config_sync = ConfigSync()
+
+
+def inbound_pipeline(name: str, default_handler, **kwargs) -> InboundPipeline:
+    return InboundPipeline(
+        name,
+        default_handler,
+        queue_size=config.getint("inbound", "queue_size", fallback=10000),
+        batch_size=config.getint("inbound", "batch_size", fallback=500),
+        rate=config.getfloat("inbound", "message_rate", fallback=20),
+        burst=config.getint("inbound", "message_burst", fallback=50),
+        **kwargs,
+    )
+
+
+# Status reports carry no action, all of them are applied as one batch
+client_status_inbound = inbound_pipeline("client_status_socket", update_client_statuses, message_type=lambda _: None)
+client_inbound = inbound_pipeline(
+    "client_socket", per_message(update_client_config), handlers={"config_ack": acknowledge_client_configs}
+)
+
+
+# Admission control for client traffic only, operator endpoints and the status socket are never limited
+connect_admission = AdmissionController(
+    "connect",
+    rate=config.getfloat("admission", "connect_rate", fallback=50),
+    burst=config.getint("admission", "connect_burst", fallback=100),
+    max_concurrent=config.getint("admission", "connect_max_concurrent", fallback=20),
+    retry_after=config.getfloat("admission", "retry_after", fallback=1),
+)
+socket_admission = AdmissionController(
+    "client_socket",
+    rate=config.getfloat("admission", "socket_rate", fallback=100),
+    burst=config.getint("admission", "socket_burst", fallback=200),
+    max_concurrent=config.getint("admission", "socket_max_concurrent", fallback=50),
+    retry_after=config.getfloat("admission", "retry_after", fallback=1),
+)
+
+drain_reconnect_min = config.getfloat("drain", "reconnect_min", fallback=1)
+drain_reconnect_max = config.getfloat("drain", "reconnect_max", fallback=30)
+drain_timeout = config.getfloat("drain", "timeout", fallback=5)
+
+# Status sockets are used by operators and sharded by team, client sockets by username hash
+client_status_sockets = SocketManager(
+    router,
+    "/client_status_socket",
+    True,
+    send_client_status,
+    update_client_status,
+    client_status_socket_closed,
+    inbound=client_status_inbound,
+    queue_size=config.getint("sharding", "queue_size", fallback=1000),
+    threaded_shards=config.getboolean("sharding", "threaded", fallback=False),
+    send_timeout=config.getfloat("sharding", "send_timeout", fallback=5),
+)
+client_sockets = SocketManager(
+    router,
+    "/client_socket",
+    True,
+    send_client_config,
+    update_client_config,
+    client_socket_closed,
+    inbound=client_inbound,
+    admission=socket_admission,
+    handshake_timeout=config.getfloat("admission", "socket_handshake_timeout", fallback=10),
+    compression_threshold=config.getint("protocol", "compression_threshold", fallback=4096),
+    max_message_size=config.getint("protocol", "max_message_size", fallback=1024 * 1024),
+    hash_shards=config.getint("sharding", "client_shards", fallback=4),
+    queue_size=config.getint("sharding", "queue_size", fallback=1000),
+    threaded_shards=config.getboolean("sharding", "threaded", fallback=False),
+    send_timeout=config.getfloat("sharding", "send_timeout", fallback=5),
+)
 
 
 @router.get(
@@ -116,14 +378,22 @@ class ClientsInfoResponse(BaseModel):
 )
 async def get_client_info(
     # username: str = Depends(current_user),
-) -> ClientInfo:
-    return {"clients_info": [client for client in clients_info.values()]}
+) -> Response:
+    clients = [
+        {**client, "current_behaviour": behaviour_tracker.current_behaviour(client["username"])}
+        for client in clients_info.values()
+    ]
+    # Validating and encoding large listings is CPU heavy, they are encoded in a compute worker
+    body = await compute_pool.run("client_listing", len(clients), encode_clients_info, clients)
+    return Response(body, media_type="application/json")
 
 
 class ConnectResponse(BaseModel):
     access_token: str
     token_type: str
-    client_config: ClientConfig
+    client_config: ClientConfig | None
+    config_version: str
+    socket_url: str
 
 
 @router.post(
@@ -132,14 +402,31 @@ class ConnectResponse(BaseModel):
     description="Add client to the list of active clients, future status updates will be "
     "streamed via a websocket created like this:<br>"
     '`var socket = new WebSocket("ws://localhost:8000/client_socket");`'
-    "<br><br>**Required fields:** username, password, hostname",
+    "<br><br>**Required fields:** username, password, hostname"
+    "<br>**Optional fields:** config_version, the version of the client config the client already has. "
+    "When it is current, `client_config` is null and the client keeps its config."
+    "<br><br>In a multi-instance deployment the connect is forwarded to the instance owning the hostname, "
+    "the client opens its socket at `socket_url`."
+    "<br><br>Responds with 503 and a `Retry-After` header while the server is admitting too many clients.",
+    dependencies=[Depends(admission_dependency(connect_admission))],
 )
 async def connect_client(
     form_data: Annotated[OAuth2PasswordRequestFormWithHostname, Depends()],
+    request: Request,
 ) -> ConnectResponse:
     """
     Authenticate a user and generate a JWT token
     """
+    if not cluster.is_local(form_data.hostname) and not cluster.is_forwarded(request):
+        return await forward_connect(form_data, request)
+
+    if draining:
+        raise HTTPException(
+            status_code=503,
+            detail="errors.server_busy",
+            headers={"Retry-After": str(round(random.uniform(drain_reconnect_min, drain_reconnect_max)))},
+        )
+
     if not form_data.hostname or len(form_data.hostname.strip()) == 0:
         logging.warning(f"Missing hostname for user {form_data.username}")
         raise HTTPException(status_code=400, detail="errors.hostname_required")
@@ -148,49 +435,370 @@ async def connect_client(
         logging.warning(f"Invalid hostname '{form_data.hostname}' for user {form_data.username}")
         raise HTTPException(status_code=400, detail="errors.invalid_hostname")
 
-    if not (
-        form_data.username in available_client_users.keys()
-        and form_data.password == available_client_users[form_data.username]["password"]
-    ):
+    password = credential_store.get_password(credentials_key, form_data.username)
+    if password is None or form_data.password != password:
         logging.warning(f"Invalid login attempt from user {form_data.username} with hostname {form_data.hostname}")
         raise HTTPException(status_code=401, detail="errors.invalid_username_or_password")
 
     logging.info(f"User {form_data.username} logged in from hostname {form_data.hostname}")
 
-    user = available_client_users[form_data.username]
-
     if form_data.hostname not in clients_info:
-        clients_info[form_data.hostname] = {
-            "username": form_data.username,
-            "current_behaviour": None,
-            "client_config": config_generator.generate_config(user["username"]),
-            "hostname": form_data.hostname,
-        }
-    else:
-        clients_info[form_data.hostname]["hostname"] = form_data.hostname
+        # Pooled configs are interned already, the conversation fields are applied without modifying them
+        client_config = config_pool.take(template_version)
+        if client_config is None:
+            client_config = config_interner.intern(config_generator.generate_config(form_data.username))
+        else:
+            client_config = config_generator.assign_conversation(client_config, form_data.username)
+        clients_info[sys.intern(form_data.hostname)] = client_info_entry(
+            form_data.username, form_data.hostname, client_config, interned=True
+        )
 
-    token = jwt.encode(
-        {
-            "sub": user["username"],
-            "hostname": form_data.hostname,
-            "exp": int(time.time()) + JWT_EXPIRATION,
-        },
-        JWT_SECRET,
-        algorithm=JWT_ALGORITHM,
-    )
+    token = create_token(form_data.username, form_data.hostname)
 
+    client_config = clients_info[form_data.hostname]["client_config"]
+    version = config_version(client_config)
+    journal.record("client_connect", form_data.username, hostname=form_data.hostname, config_version=version)
     return {
         "access_token": token,
         "token_type": "bearer",
-        "client_config": clients_info[form_data.hostname]["client_config"],
+        "client_config": None if form_data.config_version == version else client_config,
+        "config_version": version,
+        "socket_url": f"{local_ws_url(request)}/client/client_socket",
     }
 
 
-@router.delete("/disconnect")
+def local_ws_url(request: Request) -> str:
+    if cluster.enabled:
+        return cluster.instances[cluster.name].ws_url
+    return str(request.base_url).rstrip("/").replace("http", "ws", 1)
+
+
+async def forward_connect(form_data: OAuth2PasswordRequestFormWithHostname, request: Request) -> Response:
+    """Authenticate the client at the instance owning its hostname, that instance keeps its clients_info entry"""
+    owner = cluster.owner(form_data.hostname)
+    form = {"username": form_data.username, "password": form_data.password, "hostname": form_data.hostname}
+    if form_data.config_version is not None:
+        form["config_version"] = form_data.config_version
+    try:
+        response = await cluster.forward(owner, request, data=form)
+    except httpx.HTTPError as ex:
+        logging.error(f"Cannot forward connect of {form_data.hostname} to instance {owner.name}: {ex!r}")
+        raise HTTPException(
+            status_code=503,
+            detail="errors.server_busy",
+            headers={"Retry-After": str(round(random.uniform(drain_reconnect_min, drain_reconnect_max)))},
+        )
+    headers = {"Retry-After": response.headers["retry-after"]} if "retry-after" in response.headers else None
+    return Response(response.content, status_code=response.status_code, headers=headers, media_type="application/json")
+
+
+class ClientRegistration(BaseModel):
+    username: str
+    hostname: str
+
+
+class GenerateConfigsResponse(BaseModel):
+    generated: int
+    skipped: int
+
+
+async def generate_client_configs(usernames: list[str]) -> list[dict]:
+    """Generate configs in bulk, in a compute worker for large batches, continuing the conversation starter state"""
+    # Connects during the generation continue after the reserved clients
+    state = config_generator.reserve_conversation(usernames)
+    configs, _ = await compute_pool.run(
+        "generate_configs", len(usernames), generate_configs, config_generator.generator_config, state, usernames
+    )
+    return configs
+
+
+@router.post(
+    "/configs",
+    response_model=GenerateConfigsResponse,
+    description="Generate client configs ahead of the exercise for a list of username and hostname pairs, "
+    "clients get the prepared config on their first connect. Hostnames that already have a config are skipped.",
+    dependencies=[Depends(admin_user)],
+)
+async def register_clients(registrations: list[ClientRegistration]) -> GenerateConfigsResponse:
+    new = {}
+    for registration in registrations:
+        if not is_valid_hostname(registration.hostname):
+            raise HTTPException(status_code=400, detail="errors.invalid_hostname")
+        if registration.hostname not in clients_info:
+            new[registration.hostname] = registration.username
+    configs = await generate_client_configs(list(new.values()))
+    for (hostname, username), client_config in zip(new.items(), configs):
+        clients_info.setdefault(sys.intern(hostname), client_info_entry(username, hostname, client_config))
+    return {"generated": len(new), "skipped": len(registrations) - len(new)}
+
+
+async def close_revoked_sockets(jtis: list[str]) -> int:
+    return await client_sockets.close_sessions(jtis) + await client_status_sockets.close_sessions(jtis)
+
+
+@router.delete(
+    "/disconnect",
+    description="Forget a client, revoke the tokens issued to its hostname and close its sockets",
+    dependencies=[Depends(admin_user)],
+)
 async def disconnect_client(hostname: str) -> dict:
     global clients_info
     if hostname in clients_info:
-        del clients_info[hostname]
+        client = clients_info.pop(hostname)
+        # Tokens issued to the host stop working and its sockets are closed
+        jtis = sessions.revoke_hostname(hostname)
+        closed = await client_sockets.close_hostname(hostname) + await client_status_sockets.close_hostname(hostname)
+        config_sync.forget(hostname)
+        journal.record("client_disconnect", client["username"], hostname=hostname, revoked=len(jtis))
+        logging.info(f"Client {hostname} disconnected, revoked {len(jtis)} tokens and closed {closed} sockets")
         return {"message": f"Client {hostname} disconnected"}
     else:
         raise HTTPException(status_code=404, detail="Client not found")
+
+
+@router.get(
+    "/sessions",
+    description="Get issued and revoked token counts, or the latest session of one hostname",
+    dependencies=[Depends(admin_user)],
+)
+async def get_sessions(hostname: str | None = None) -> dict:
+    if hostname is None:
+        return sessions.stats()
+    session = sessions.sessions.get(sessions.hostname_sessions.get(hostname))
+    return {"sessions": [session.dict()] if session else []}
+
+
+@router.delete(
+    "/sessions/{jti}",
+    description="Revoke a token by its token ID (jti claim) and close the sockets using it, e.g. for a "
+    "compromised client. `expires_at` is required for tokens issued by another instance.",
+    dependencies=[Depends(admin_user)],
+)
+async def revoke_session(jti: str, expires_at: int | None = None) -> dict:
+    if not sessions.revoke(jti, expires_at):
+        raise HTTPException(status_code=404, detail="errors.session_not_found")
+    closed = await close_revoked_sockets([jti])
+    journal.record("session_revoked", None, jti=jti)
+    logging.info(f"Revoked token {jti}, closed {closed} sockets")
+    return {"message": f"Token {jti} revoked", "closed_sockets": closed}
+
+
+class CredentialsStatsResponse(BaseModel):
+    loaded_at: float
+    parse_seconds: float
+    entries: dict[str, int]
+    index_bytes: int
+
+
+@router.get(
+    "/credentials",
+    response_model=CredentialsStatsResponse,
+    description="Get statistics of the loaded client credentials",
+    dependencies=[Depends(admin_user)],
+)
+async def get_credentials_stats() -> CredentialsStatsResponse:
+    return credential_store.stats
+
+
+@router.post(
+    "/credentials/reload",
+    response_model=CredentialsStatsResponse,
+    description="Reload client credentials from the credentials file, the file is also reloaded automatically "
+    "when it changes",
+    dependencies=[Depends(admin_user)],
+)
+async def reload_credentials() -> CredentialsStatsResponse:
+    stats = await run_in_threadpool(credential_store.load)
+    logging.info(f"Reloaded credentials: {stats['entries']} in {stats['parse_seconds'] * 1000:.1f} ms")
+    return stats
+
+
+@router.get(
+    "/admission",
+    description="Get admission control statistics for client connects and client socket handshakes",
+    dependencies=[Depends(admin_user)],
+)
+async def get_admission_stats() -> dict:
+    return {"admission": [connect_admission.stats(), socket_admission.stats()]}
+
+
+@router.get(
+    "/compute",
+    description="Get compute pool workers and inline/offloaded timings per task",
+    dependencies=[Depends(admin_user)],
+)
+async def get_compute_stats() -> dict:
+    return compute_pool.stats()
+
+
+@router.get(
+    "/cluster",
+    description="Get the instances of a multi-instance deployment with their share of hostnames, "
+    "or the instance owning `hostname`",
+    dependencies=[Depends(admin_user)],
+)
+async def get_cluster(hostname: str | None = None) -> dict:
+    if hostname is not None:
+        owner = cluster.owner(hostname) if cluster.enabled else None
+        return {"hostname": hostname, "instance": owner.name if owner else cluster.name}
+    return cluster.stats()
+
+
+@router.get(
+    "/memory",
+    description="Get estimated memory per connection and totals per socket manager, and the memory of "
+    "clients_info with and without the configs shared between clients, in bytes",
+    dependencies=[Depends(admin_user)],
+)
+async def get_memory_stats() -> dict:
+    shared = deep_sizeof(clients_info)
+    # Every client counted on its own, as if no strings or configs were shared
+    unshared = sys.getsizeof(clients_info) + sum(
+        deep_sizeof(hostname) + deep_sizeof(client) for hostname, client in clients_info.items()
+    )
+    return {
+        "client_sockets": client_sockets.memory_stats(),
+        "client_status_sockets": client_status_sockets.memory_stats(),
+        "clients_info": {
+            "clients": len(clients_info),
+            "bytes": shared,
+            "bytes_without_sharing": unshared,
+            "per_client": shared // len(clients_info) if clients_info else 0,
+        },
+        "config_interner": config_interner.stats(),
+    }
+
+
+@router.get(
+    "/shards",
+    description="Get connection and send queue statistics of the socket shards",
+    dependencies=[Depends(admin_user)],
+)
+async def get_shard_stats() -> dict:
+    return {
+        "client_sockets": client_sockets.shard_stats(),
+        "client_status_sockets": client_status_sockets.shard_stats(),
+    }
+
+
+@router.get(
+    "/config_pool",
+    description="Get pre-generated config pool statistics: ready configs, hit rate and refill lag",
+    dependencies=[Depends(admin_user)],
+)
+async def get_config_pool_stats() -> dict:
+    return config_pool.stats()
+
+
+profile_max_seconds = config.getfloat("profiler", "max_seconds", fallback=60)
+
+
+@router.get(
+    "/profile",
+    description="Sample the stacks of the event loop and all worker threads for `seconds` and return the profile "
+    "as collapsed stacks (flamegraph.pl, speedscope) or a speedscope file, together with the asyncio tasks grouped "
+    "by origin when profiling ended. Only one profile runs at a time.",
+    dependencies=[Depends(admin_user)],
+)
+async def get_profile(
+    seconds: Annotated[float, Query(gt=0, le=profile_max_seconds)] = 5,
+    interval_ms: Annotated[float, Query(ge=1, le=1000)] = config.getfloat("profiler", "interval_ms", fallback=10),
+    format: Annotated[str, Query(pattern="^(collapsed|speedscope)$")] = "collapsed",
+) -> dict:
+    profile = await run_in_threadpool(profiler.run, seconds, interval_ms / 1000)
+    if profile is None:
+        raise HTTPException(status_code=409, detail="errors.profiler_busy")
+    return {
+        "seconds": profile.duration,
+        "samples": profile.samples,
+        "threads": profile.threads(),
+        "tasks": task_snapshot(),
+        "profile": profile.collapsed() if format == "collapsed" else profile.speedscope(),
+    }
+
+
+@router.get(
+    "/tasks",
+    description="Get the asyncio tasks of the event loop grouped by origin: socket handlers, middleware, "
+    "behaviour dispatches and the endpoints or modules they are running in",
+    dependencies=[Depends(admin_user)],
+)
+async def get_tasks() -> dict:
+    return task_snapshot()
+
+
+@router.get(
+    "/inbound",
+    description="Get received, rate limited, dropped and batched message counts of the socket inbound pipelines",
+    dependencies=[Depends(admin_user)],
+)
+async def get_inbound_stats() -> dict:
+    return {"client_sockets": client_inbound.stats(), "client_status_sockets": client_status_inbound.stats()}
+
+
+async def drain_clients() -> dict:
+    """
+    Stop accepting clients, save clients_info for the next instance and tell connected clients
+    to reconnect after a randomized delay
+    """
+    global draining
+    draining = True
+    save_clients_state(state_file)
+    client_count = await client_sockets.drain(drain_reconnect_min, drain_reconnect_max, drain_timeout)
+    status_count = await client_status_sockets.drain(drain_reconnect_min, drain_reconnect_max, drain_timeout)
+    logging.info(
+        f"Drained {client_count} client sockets and {status_count} status sockets, "
+        f"saved {len(clients_info)} clients to {state_file}"
+    )
+    await asyncio.to_thread(journal.flush)
+    return {"clients_saved": len(clients_info), "client_sockets": client_count, "status_sockets": status_count}
+
+
+@router.post(
+    "/drain",
+    description="Drain the server before a restart: new connects and sockets are rejected, connected clients are "
+    "asked to reconnect after a randomized delay and clients_info is saved for the next instance",
+    dependencies=[Depends(admin_user)],
+)
+async def drain() -> dict:
+    return await drain_clients()
+
+
+@router.post(
+    "/takeover",
+    description="Take over the clients saved by a drained instance now, instead of when the state file is noticed",
+    dependencies=[Depends(admin_user)],
+)
+async def takeover() -> dict:
+    return {"clients_taken_over": 0 if draining else take_over_clients_state(state_file)}
+
+
+@router.get(
+    "/journal",
+    description="Export the event journal as NDJSON, one event per line, oldest first. "
+    "<br>Filters: `since` and `until` (ISO date or unix timestamp), `client` and `event`, both repeatable. "
+    "The export is streamed, it can be replayed with `python replay.py journal.ndjson`.",
+    dependencies=[Depends(admin_user)],
+)
+async def export_journal(
+    since: datetime | None = None,
+    until: datetime | None = None,
+    client: Annotated[list[str] | None, Query()] = None,
+    event: Annotated[list[str] | None, Query()] = None,
+) -> StreamingResponse:
+    lines = journal.export(
+        since.timestamp() if since else None,
+        until.timestamp() if until else None,
+        clients=client,
+        events=event,
+    )
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@router.get(
+    "/journal/stats",
+    description="Get event journal statistics",
+    dependencies=[Depends(admin_user)],
+)
+async def get_journal_stats() -> dict:
+    return journal.stats()
@@ -1,10 +1,17 @@
+import asyncio
+import functools
+import json
+import logging
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from typing import Annotated, Any, Dict, List, Optional
 
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, Field
+import httpx
+from fastapi import APIRouter, HTTPException, Query, Request, WebSocket
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 
-from client import client_sockets
+from behaviour_tracker import ACTIVE_STATES, BehaviourState
+from client import behaviour_tracker, client_sockets, config_sync, journal
+from cluster import cluster
 
 router = APIRouter()
 
@@ -89,6 +96,7 @@ class BehaviorResponse(BaseModel):
     behaviour_id: str
     config_keys: List[str] = Field(default_factory=list)
     clients_notified: int
+    clients_dropped: int = 0  # sockets whose send queue was full
     validated_config: Optional[Dict[str, Any]] = None
 
 
@@ -96,6 +104,7 @@ class BehaviorRunResponse(BehaviorResponse):
     """Response for behavior run operations"""
 
     config_updated: bool = False
+    run_id: Optional[int] = None
 
 
 # Define which behaviors require mandatory configuration
@@ -122,10 +131,24 @@ BEHAVIOR_CONFIG_MAPPING = {
     AvailableBehaviors.WORK_ORGANIZATION_WEB: WorkOrganizationWebConfig,
 }
 
+# Validators are built once per behavior instead of on every request
+BEHAVIOR_CONFIG_ADAPTERS = {behaviour: TypeAdapter(model) for behaviour, model in BEHAVIOR_CONFIG_MAPPING.items()}
+
+# Number of distinct (behavior, config) validation results kept, campaigns repeat the same configs a lot
+VALIDATION_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=VALIDATION_CACHE_SIZE)
+def _validate_canonical_config(behaviour_id: AvailableBehaviors, canonical_config: str) -> dict:
+    return BEHAVIOR_CONFIG_ADAPTERS[behaviour_id].validate_json(canonical_config).model_dump()
+
 
 # Helper function to validate config based on behavior
 def validate_behavior_config(behaviour_id: AvailableBehaviors, behaviour_config: Optional[dict]) -> Optional[dict]:
-    """Validate configuration against the specific behavior model"""
+    """
+    Validate configuration against the specific behavior model.
+    Results are cached by canonical config, the returned dict is shared and must not be modified.
+    """
 
     # If no config provided
     if behaviour_config is None:
@@ -137,17 +160,107 @@ def validate_behavior_config(behaviour_id: AvailableBehaviors, behaviour_config:
         return None
 
     # If config is provided, validate it
-    config_model = BEHAVIOR_CONFIG_MAPPING.get(behaviour_id)
-    if not config_model:
+    if behaviour_id not in BEHAVIOR_CONFIG_ADAPTERS:
         return behaviour_config
 
     try:
-        validated_config = config_model(**behaviour_config)
-        return validated_config.dict()
-    except Exception as e:
+        canonical_config = json.dumps(behaviour_config, sort_keys=True, separators=(",", ":"))
+        return _validate_canonical_config(behaviour_id, canonical_config)
+    except (ValidationError, TypeError, ValueError) as e:
         raise HTTPException(status_code=422, detail=f"Invalid configuration for {behaviour_id.value}: {str(e)}")
 
 
+def client_user_sockets(client_username: str) -> list[WebSocket]:
+    return client_sockets.sockets_for_user(client_username)
+
+
+async def forward_dispatch(
+    request: Request, client_username: str, hostname: Optional[str], behaviour_config: Optional[dict]
+) -> Optional[dict]:
+    """
+    Forward a dispatch to the instance owning the client and return its response, None when it is handled here.
+    Without a hostname the dispatch goes to every other instance and the ones with sockets of the client run it.
+    """
+    if not cluster.enabled or cluster.is_forwarded(request):
+        return None
+    if hostname is not None:
+        if cluster.is_local(hostname):
+            return None
+        instances = [cluster.owner(hostname)]
+    elif client_user_sockets(client_username):
+        return None
+    else:
+        instances = cluster.peers()
+
+    responses = await asyncio.gather(
+        *(cluster.forward(instance, request, json=behaviour_config) for instance in instances), return_exceptions=True
+    )
+    results = []
+    failed: Optional[httpx.Response] = None
+    for response in responses:
+        if not isinstance(response, httpx.Response):
+            continue
+        try:
+            result = response.json()
+            if response.is_success:
+                BehaviorResponse.model_validate(result)
+        except ValueError:  # not a JSON body, e.g. a plain text 500, or not a behaviour response
+            result = None
+        if response.is_success and result is not None:
+            results.append(result)
+        else:
+            logging.warning(f"Dispatch forwarded to {response.url.host} failed with {response.status_code}")
+            failed = response
+    for result in results:
+        if result.get("status") == "success":
+            return result
+    if hostname is not None:
+        if results:
+            return results[0]
+        if failed is not None:
+            raise peer_error(failed)
+        raise HTTPException(status_code=503, detail="errors.server_busy")
+    return None
+
+
+def peer_error(response: httpx.Response) -> HTTPException:
+    """Pass the status and detail of a failed response from another instance through"""
+    try:
+        detail = response.json().get("detail")
+    except (ValueError, AttributeError):
+        detail = None
+    headers = {"Retry-After": response.headers["retry-after"]} if "retry-after" in response.headers else None
+    # A successful response that is not a behaviour response is a bad gateway answer
+    status_code = 502 if response.is_success else response.status_code
+    return HTTPException(status_code=status_code, detail=detail or response.text or None, headers=headers)
+
+
+async def send_behaviour_config(
+    sockets: list[WebSocket], behaviour_id: AvailableBehaviors, validated_config: Optional[dict]
+) -> int:
+    """Queue the config for the sockets, returns the number of sockets it was queued for"""
+    queued = 0
+    messages = {}
+    for socket in sockets:
+        client = client_sockets.client_id(socket)
+        if client is None:
+            continue
+        # One version per client, sent as a patch against the previous config when the client acknowledged it
+        if client not in messages:
+            messages[client] = config_sync.push_message(client, behaviour_id.value, validated_config)
+        queued += client_sockets.queue_json(socket, messages[client])
+    return queued
+
+
+def delivery(notified: int, sockets: list[WebSocket], message: str) -> tuple[str, str]:
+    """Status and message of a dispatch, messages are dropped when the send queue of a socket is full"""
+    if notified == len(sockets):
+        return "success", message
+    if not notified:
+        return "error", "Nothing was sent, the send queues of the client sockets are full"
+    return "partial", f"{message} ({len(sockets) - notified} of {len(sockets)} messages dropped, send queue full)"
+
+
 @router.post(
     "/update_config",
     response_model=BehaviorResponse,
@@ -156,7 +269,11 @@ def validate_behavior_config(behaviour_id: AvailableBehaviors, behaviour_config:
     # dependencies=[Depends(current_user)],
 )
 async def update_behaviour_config(
-    client_username: str, behaviour_id: AvailableBehaviors, behaviour_config: Optional[dict] = None
+    client_username: str,
+    behaviour_id: AvailableBehaviors,
+    request: Request,
+    behaviour_config: Optional[dict] = None,
+    hostname: Optional[str] = None,
 ) -> BehaviorResponse:
     """
     Update behaviour configuration for a specific client with validation.
@@ -165,6 +282,7 @@ async def update_behaviour_config(
         client_username: The username/email of the target client
         behaviour_id: The behavior to configure
         behaviour_config: Behavior-specific configuration dictionary
+        hostname: Optional hostname of the client, routes the update directly to the instance owning it
 
     Returns:
         BehaviorResponse with details about the update operation
@@ -172,7 +290,11 @@ async def update_behaviour_config(
     # Validate the configuration
     validated_config = validate_behavior_config(behaviour_id, behaviour_config)
 
-    sockets = [socket for socket, username in client_sockets.connected_sockets.items() if username == client_username]
+    forwarded = await forward_dispatch(request, client_username, hostname, behaviour_config)
+    if forwarded is not None:
+        return forwarded
+
+    sockets = client_user_sockets(client_username)
 
     if not sockets:
         return BehaviorResponse(
@@ -188,19 +310,23 @@ async def update_behaviour_config(
     else:
         config_summary = " (config cleared)"
 
-    for socket in sockets:
-        await socket.send_json(
-            {"action": "update_behaviour_config", "behaviour_id": behaviour_id.value, "config": validated_config}
-        )
+    notified = await send_behaviour_config(sockets, behaviour_id, validated_config)
+    journal.record("behaviour_config", client_username, behaviour_id=behaviour_id.value, config=validated_config)
+    status, message = delivery(
+        notified,
+        sockets,
+        f"""Successfully updated '{behaviour_id.value}'
+            behaviour configuration for client '{client_username}'{config_summary}""",
+    )
 
     return BehaviorResponse(
-        message=f"""Successfully updated '{behaviour_id.value}'
-            behaviour configuration for client '{client_username}'{config_summary}""",
-        status="success",
+        message=message,
+        status=status,
         client_username=client_username,
         behaviour_id=behaviour_id.value,
         config_keys=list(validated_config.keys()) if validated_config else [],
-        clients_notified=len(sockets),
+        clients_notified=notified,
+        clients_dropped=len(sockets) - notified,
         validated_config=validated_config,
     )
 
@@ -214,7 +340,11 @@ async def update_behaviour_config(
     # dependencies=[Depends(current_user)],
 )
 async def run_behaviour(
-    client_username: str, behaviour_id: AvailableBehaviors, behaviour_config: Optional[dict] = None
+    client_username: str,
+    behaviour_id: AvailableBehaviors,
+    request: Request,
+    behaviour_config: Optional[dict] = None,
+    hostname: Optional[str] = None,
 ) -> BehaviorRunResponse:
     """
     Execute a behaviour on a specific client with optional validated configuration.
@@ -225,6 +355,7 @@ async def run_behaviour(
         behaviour_config: Optional behavior-specific configuration. Not needed for
                         'procrastination' and 'work_organization_web' behaviors.
                         Required for attack behaviors and 'work_emails'.
+        hostname: Optional hostname of the client, routes the run directly to the instance owning it
 
     Returns:
         BehaviorRunResponse with details about the execution request
@@ -232,7 +363,11 @@ async def run_behaviour(
     # Validate the configuration (returns None for behaviors that don't need config)
     validated_config = validate_behavior_config(behaviour_id, behaviour_config)
 
-    sockets = [socket for socket, username in client_sockets.connected_sockets.items() if username == client_username]
+    forwarded = await forward_dispatch(request, client_username, hostname, behaviour_config)
+    if forwarded is not None:
+        return forwarded
+
+    sockets = client_user_sockets(client_username)
 
     if not sockets:
         return BehaviorRunResponse(
@@ -247,18 +382,39 @@ async def run_behaviour(
     # Update configuration only if config was provided and the behavior supports configuration
     config_updated = False
     if validated_config is not None and behaviour_config is not None and behaviour_id not in BEHAVIORS_WITHOUT_CONFIG:
-        await update_behaviour_config(client_username, behaviour_id, validated_config)
+        # Already validated above, send it directly instead of going through update_behaviour_config
+        await send_behaviour_config(sockets, behaviour_id, validated_config)
         config_updated = True
 
+    # Track the run, it moves to "sent" once the command is written to a socket and clients report the rest
+    run = behaviour_tracker.queue(client_username, behaviour_id.value)
+    on_sent = functools.partial(behaviour_tracker.transition, client_username, BehaviourState.SENT, run_id=run.run_id)
+
     # Send run command to all connected sockets for this client
+    notified = 0
     for socket in sockets:
-        await socket.send_json(
+        notified += client_sockets.queue_json(
+            socket,
             {
                 "action": "run_behaviour",
                 "behaviour_id": behaviour_id.value,
                 "config": validated_config,  # Will be None for config-less behaviors
-            }
+                "run_id": run.run_id,
+            },
+            on_sent,
         )
+    if not notified:
+        behaviour_tracker.transition(
+            client_username, BehaviourState.FAILED, run_id=run.run_id, detail="send queue full"
+        )
+    journal.record(
+        "behaviour_run",
+        client_username,
+        behaviour_id=behaviour_id.value,
+        run_id=run.run_id,
+        config=validated_config,
+        config_updated=config_updated,
+    )
 
     # Determine message based on behavior type
     if behaviour_id in BEHAVIORS_WITHOUT_CONFIG:
@@ -268,13 +424,63 @@ async def run_behaviour(
     else:
         config_note = ""
 
+    status, message = delivery(
+        notified,
+        sockets,
+        f"Successfully initiated '{behaviour_id.value}' behaviour on client '{client_username}'{config_note}",
+    )
     return BehaviorRunResponse(
-        message=f"Successfully initiated '{behaviour_id.value}' behaviour on client '{client_username}'{config_note}",
-        status="success",
+        message=message,
+        status=status,
         client_username=client_username,
         behaviour_id=behaviour_id.value,
         config_updated=config_updated,
         config_keys=list(validated_config.keys()) if validated_config else [],
-        clients_notified=len(sockets),
+        clients_notified=notified,
+        clients_dropped=len(sockets) - notified,
         validated_config=validated_config if validated_config else None,
+        run_id=run.run_id,
     )
+
+
+class BehaviorClientsResponse(BaseModel):
+    behaviour_id: str
+    states: List[BehaviourState]
+    clients: List[str]
+
+
+@router.get(
+    "/clients",
+    response_model=BehaviorClientsResponse,
+    description="""Get clients whose latest run of a behaviour is in one of the given states,
+    by default the active ones (queued, sent, running).""",
+    # dependencies=[Depends(current_user)],
+)
+async def get_behaviour_clients(
+    behaviour_id: AvailableBehaviors, state: Annotated[Optional[List[BehaviourState]], Query()] = None
+) -> BehaviorClientsResponse:
+    states = set(state) if state else ACTIVE_STATES
+    return BehaviorClientsResponse(
+        behaviour_id=behaviour_id.value,
+        states=sorted(states),
+        clients=behaviour_tracker.clients(behaviour_id.value, states),
+    )
+
+
+class BehaviorRun(BaseModel):
+    run_id: int
+    client: str
+    behaviour_id: str
+    state: BehaviourState
+    timestamps: Dict[str, float]
+    detail: Optional[str] = None
+
+
+@router.get(
+    "/history",
+    response_model=List[BehaviorRun],
+    description="Get the most recent behaviour runs of a client, oldest first",
+    # dependencies=[Depends(current_user)],
+)
+async def get_behaviour_history(client_username: str) -> List[BehaviorRun]:
+    return behaviour_tracker.client_history(client_username)
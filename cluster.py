@@ -0,0 +1,130 @@
+"""
+Instance-aware mode: clients are spread over several server instances by consistent hashing of their hostname.
+
+Each instance places `vnodes` points per instance on a hash ring, a hostname belongs to the first point after its
+own hash. Adding or removing an instance only moves the hostnames on the arcs of that instance, about 1/N of them.
+Requests for clients of another instance are forwarded to it over a keep-alive HTTP connection, forwarded
+requests carry the FORWARDED_HEADER and are never forwarded again.
+
+    [cluster]
+    instances =
+        a = http://127.0.0.1:8001
+        b = http://127.0.0.1:8002
+"""
+
+import bisect
+import hashlib
+import os
+
+import httpx
+from fastapi import Request
+
+from startup import load_config
+
+FORWARDED_HEADER = "X-Cluster-Forwarded"
+
+
+class Instance:
+    __slots__ = ("name", "url")
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url.rstrip("/")
+
+    @property
+    def ws_url(self) -> str:
+        return self.url.replace("http", "ws", 1)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, instances: list[str], vnodes: int = 100):
+        points = sorted((_hash(f"{name}#{i}"), name) for name in instances for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def owner(self, key: str) -> str:
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.names[index]
+
+    def shares(self) -> dict[str, float]:
+        """Fraction of the hash space owned by every instance"""
+        shares = dict.fromkeys(self.names, 0.0)
+        previous = self.hashes[-1] - 2**64
+        for point, name in zip(self.hashes, self.names):
+            shares[name] += (point - previous) / 2**64
+            previous = point
+        return shares
+
+
+class Cluster:
+    def __init__(self, name: str, instances: dict[str, str], vnodes: int = 100, timeout: float = 10):
+        self.name = name
+        self.instances = {name: Instance(name, url) for name, url in instances.items()}
+        self.ring = HashRing(list(self.instances), vnodes) if self.instances else None
+        self.timeout = timeout
+        self._http: httpx.AsyncClient | None = None
+        self.forwarded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ring is not None and self.name in self.instances
+
+    def owner(self, hostname: str) -> Instance:
+        return self.instances[self.ring.owner(hostname)]
+
+    def is_local(self, hostname: str) -> bool:
+        return not self.enabled or self.ring.owner(hostname) == self.name
+
+    def peers(self) -> list[Instance]:
+        return [instance for name, instance in self.instances.items() if name != self.name]
+
+    @staticmethod
+    def is_forwarded(request: Request) -> bool:
+        return FORWARDED_HEADER in request.headers
+
+    async def forward(self, instance: Instance, request: Request, **kwargs) -> httpx.Response:
+        """Send the request to another instance, kwargs replace the body (data=..., json=...)"""
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=self.timeout)
+        headers = {FORWARDED_HEADER: self.name}
+        if "accept-language" in request.headers:
+            headers["Accept-Language"] = request.headers["accept-language"]
+        self.forwarded += 1
+        return await self._http.request(
+            request.method,
+            f"{instance.url}{request.url.path}",
+            params=request.query_params,
+            headers=headers,
+            **kwargs,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "instance": self.name,
+            "enabled": self.enabled,
+            "instances": {name: instance.url for name, instance in self.instances.items()},
+            "shares": self.ring.shares() if self.ring else {},
+            "forwarded": self.forwarded,
+        }
+
+
+def parse_instances(value: str) -> dict[str, str]:
+    instances = {}
+    for line in value.splitlines():
+        name, sep, url = line.partition("=")
+        if sep:
+            instances[name.strip()] = url.strip()
+    return instances
+
+
+config = load_config()
+cluster = Cluster(
+    os.getenv("INSTANCE_NAME", config.get("cluster", "instance", fallback="")),
+    parse_instances(config.get("cluster", "instances", fallback="")),
+    vnodes=config.getint("cluster", "vnodes", fallback=100),
+    timeout=config.getfloat("cluster", "forward_timeout", fallback=10),
+)
@@ -0,0 +1,132 @@
+"""
+Process pool for CPU-bound work that would otherwise block the event loop.
+
+Every task has a name and a size cutoff, payloads below the cutoff run inline because pickling them to a worker
+costs more than the work itself. Task functions must be importable module level functions, workers are spawned
+at startup and import the task modules up front, so the first offloaded task does not pay for the imports.
+"""
+
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+from startup import load_config
+
+# Modules imported by every worker on start, they contain the task functions
+WORKER_MODULES = ("compute", "config_generator", "i18n", "models.client_info")
+
+
+def _warm_up(modules: tuple[str, ...]):
+    for module in modules:
+        importlib.import_module(module)
+
+
+def _ping() -> int:
+    time.sleep(0.1)
+    return os.getpid()
+
+
+class TaskTimings:
+    __slots__ = ("inline", "inline_seconds", "offloaded", "offloaded_seconds", "max_seconds")
+
+    def __init__(self):
+        self.inline = 0
+        self.inline_seconds = 0.0
+        self.offloaded = 0
+        self.offloaded_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def dict(self) -> dict:
+        return {
+            "inline": self.inline,
+            "inline_ms": self.inline_seconds * 1000,
+            "offloaded": self.offloaded,
+            "offloaded_ms": self.offloaded_seconds * 1000,
+            "max_ms": self.max_seconds * 1000,
+        }
+
+
+class ComputePool:
+    def __init__(self, workers: int, cutoffs: dict[str, int]):
+        self.workers = workers
+        self.cutoffs = cutoffs  # task name -> minimum size to offload
+        self.executor: ProcessPoolExecutor | None = None
+        self.worker_pids: list[int] = []
+        self.timings: dict[str, TaskTimings] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Spawn the workers and wait until every one of them is ready"""
+        with self._lock:
+            if self.executor is not None or self.workers <= 0:
+                return
+            start = time.perf_counter()
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up,
+                initargs=(WORKER_MODULES,),
+            )
+            # Workers are spawned on demand, keep all of them busy at once so that all of them are started
+            pings = [self.executor.submit(_ping) for _ in range(self.workers)]
+            self.worker_pids = sorted({ping.result() for ping in pings})
+            logging.info(f"Started {self.workers} compute workers in {time.perf_counter() - start:.2f} s")
+
+    def shutdown(self):
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+
+    def should_offload(self, name: str, size: int) -> bool:
+        return self.workers > 0 and size >= self.cutoffs.get(name, 0)
+
+    async def run(self, name: str, size: int, func: Callable, *args):
+        """Run func(*args) inline or in a worker depending on the payload size, and record the timing"""
+        offload = self.should_offload(name, size)
+        start = time.perf_counter()
+        if offload:
+            if self.executor is None:
+                await asyncio.to_thread(self.start)
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        else:
+            result = func(*args)
+        seconds = time.perf_counter() - start
+
+        timings = self.timings.get(name)
+        if timings is None:
+            timings = self.timings[name] = TaskTimings()
+        if offload:
+            timings.offloaded += 1
+            timings.offloaded_seconds += seconds
+        else:
+            timings.inline += 1
+            timings.inline_seconds += seconds
+        timings.max_seconds = max(timings.max_seconds, seconds)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "started": self.executor is not None,
+            "worker_pids": self.worker_pids,
+            "cutoffs": self.cutoffs,
+            "tasks": {name: timings.dict() for name, timings in self.timings.items()},
+        }
+
+
+config = load_config()
+compute_pool = ComputePool(
+    workers=config.getint("compute", "workers", fallback=2),
+    cutoffs={
+        "client_listing": config.getint("compute", "client_listing_cutoff", fallback=2000),
+        "translate": config.getint("compute", "translate_cutoff", fallback=256 * 1024),
+        "generate_configs": config.getint("compute", "generate_configs_cutoff", fallback=100),
+    },
+)
@@ -15,6 +15,10 @@ class ConfigGenerator:
         self.email_receivers_list = []
 
     def generate_config(self, email: str) -> dict:
+        return self.assign_conversation(self.sample_config(), email)
+
+    def sample_config(self) -> dict:
+        """Config sampled from the template, not yet part of an email conversation. Uses no shared state."""
         client_config = {}
 
         # Add general configuration
@@ -31,17 +35,6 @@ class ConfigGenerator:
             "is_conversation_starter": False,
         }
 
-        # Email conversation logic
-        if self.is_conversation_starter_counter != self.conversation_starter_frequency:
-            self.is_conversation_starter_counter += 1
-            self.email_receivers_list.append(email)
-        else:
-            work_emails_config["is_conversation_starter"] = True
-            work_emails_config["email_receivers"] = self.email_receivers_list
-
-            self.is_conversation_starter_counter = 0
-            self.email_receivers_list = []
-
         # Generate configuration for all behaviours defined in the template
         for behaviour_name, behaviour_template in self.behaviours_templates.items():
             behaviour_config = self._generate_behaviour_config(behaviour_template)
@@ -65,6 +58,59 @@ class ConfigGenerator:
 
         return client_config
 
+    def assign_conversation(self, client_config: dict, email: str) -> dict:
+        """
+        Return the config of the next client of the email conversation. The given config is not modified, it may be
+        interned and shared with other clients, the dicts on the way to work_emails are copied instead.
+        """
+        receivers = self._next_conversation_role(email)
+        if receivers is None:
+            return client_config
+        automation = client_config["automation"]
+        behaviours = automation["behaviours"]
+        work_emails_config = {
+            **behaviours["work_emails"],
+            "is_conversation_starter": True,
+            "email_receivers": receivers,
+        }
+        behaviours = {**behaviours, "work_emails": work_emails_config}
+        return {**client_config, "automation": {**automation, "behaviours": behaviours}}
+
+    def reserve_conversation(self, emails: list[str]) -> tuple[int, list[str]]:
+        """
+        Move the conversation starter state past emails whose configs are generated elsewhere, e.g. in a compute
+        worker. Returns the state to generate them from.
+        """
+        state = self.conversation_state
+        for email in emails:
+            self._next_conversation_role(email)
+        return state
+
+    def _next_conversation_role(self, email: str) -> list[str] | None:
+        """
+        Email conversation logic, every conversation_starter_frequency-th client mails the previous ones.
+        Returns the receivers if the client starts a conversation.
+        """
+        if self.is_conversation_starter_counter != self.conversation_starter_frequency:
+            self.is_conversation_starter_counter += 1
+            self.email_receivers_list.append(email)
+            return None
+        receivers = self.email_receivers_list
+        self.is_conversation_starter_counter = 0
+        self.email_receivers_list = []
+        return receivers
+
+    def generate_configs(self, emails: list[str]) -> list[dict]:
+        return [self.generate_config(email) for email in emails]
+
+    @property
+    def conversation_state(self) -> tuple[int, list[str]]:
+        return self.is_conversation_starter_counter, list(self.email_receivers_list)
+
+    @conversation_state.setter
+    def conversation_state(self, state: tuple[int, list[str]]):
+        self.is_conversation_starter_counter, self.email_receivers_list = state[0], list(state[1])
+
     def _generate_behaviour_config(self, behaviour_template: dict) -> dict:
         """Generate configuration for a specific behaviour based on its template."""
         behaviour_config = {}
@@ -97,3 +143,21 @@ class ConfigGenerator:
         if random_value > 1:
             random_value = round(random_value)
         return random_value
+
+
+def generate_configs(
+    generator_config: dict, conversation_state: tuple[int, list[str]], emails: list[str]
+) -> tuple[list[dict], tuple[int, list[str]]]:
+    """
+    Generate configs for emails continuing the given conversation starter state, runs in a compute worker.
+    Returns the configs and the new conversation starter state.
+    """
+    generator = ConfigGenerator(generator_config)
+    generator.conversation_state = conversation_state
+    return generator.generate_configs(emails), generator.conversation_state
+
+
+def sample_configs(generator_config: dict, count: int) -> list[dict]:
+    """Sample configs for the config pool, runs in a compute worker"""
+    generator = ConfigGenerator(generator_config)
+    return [generator.sample_config() for _ in range(count)]
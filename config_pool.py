@@ -0,0 +1,103 @@
+"""
+Client configs sampled from the generator template ahead of connects.
+
+Sampling a config from the template is the expensive part of a first connect and needs no shared state, so it runs
+in the background in batches. A connect takes a ready config in O(1) and only assigns it to an email conversation,
+which depends on the order in which clients connect. The pool belongs to one template version, configs sampled
+from another template are never handed out.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+# Samples count configs from the template of the pool version
+Sampler = Callable[[int], Awaitable[list[dict]]]
+
+
+class ConfigPool:
+    def __init__(self, size: int, refill_below: int):
+        self.size = size
+        self.refill_below = refill_below  # refill once fewer configs are ready, so that refills come in batches
+        self.version: str | None = None
+        self.sampler: Sampler | None = None
+        self.configs: deque[dict] = deque()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.sampled = 0
+        self.discarded = 0
+        self.low_since: float | None = None  # when the pool last dropped below refill_below
+        self.last_refill_lag = 0.0
+        self.max_refill_lag = 0.0
+        self.intern_seconds = 0.0  # spent by the sampler interning configs, off the connect path
+        self._refill_task: asyncio.Task | None = None
+
+    def set_template(self, version: str, sampler: Sampler):
+        if version == self.version:
+            return
+        self.discarded += len(self.configs)
+        self.configs.clear()
+        self.version = version
+        self.sampler = sampler
+
+    def take(self, version: str) -> dict | None:
+        """A ready config of the template version, None if the pool is empty or belongs to another version"""
+        if version == self.version and self.configs:
+            self.hits += 1
+            config = self.configs.popleft()
+        else:
+            self.misses += 1
+            config = None
+        self.refill()
+        return config
+
+    def refill(self):
+        """Start a background refill if the pool is low and no refill is running"""
+        if self.sampler is None or self.size <= 0 or len(self.configs) >= self.refill_below:
+            return
+        if self.low_since is None:
+            self.low_since = time.monotonic()
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.get_running_loop().create_task(self._refill())
+
+    async def _refill(self):
+        version = self.version
+        while len(self.configs) < self.size and version == self.version:
+            count = self.size - len(self.configs)
+            try:
+                configs = await self.sampler(count)
+            except Exception as ex:
+                logging.error(f"Cannot refill config pool with {count} configs: {ex!r}")
+                return
+            if version != self.version:
+                return
+            self.configs.extend(configs)
+            self.sampled += len(configs)
+            self.refills += 1
+
+        if self.low_since is not None:
+            self.last_refill_lag = time.monotonic() - self.low_since
+            self.max_refill_lag = max(self.max_refill_lag, self.last_refill_lag)
+            self.low_since = None
+
+    def stats(self) -> dict:
+        taken = self.hits + self.misses
+        return {
+            "version": self.version,
+            "size": self.size,
+            "ready": len(self.configs),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / taken if taken else None,
+            "refills": self.refills,
+            "sampled": self.sampled,
+            "discarded": self.discarded,
+            "refilling": self._refill_task is not None and not self._refill_task.done(),
+            "refill_lag_ms": (time.monotonic() - self.low_since) * 1000 if self.low_since is not None else 0,
+            "last_refill_lag_ms": self.last_refill_lag * 1000,
+            "max_refill_lag_ms": self.max_refill_lag * 1000,
+            "intern_ms": self.intern_seconds * 1000,
+        }
@@ -0,0 +1,112 @@
+"""
+Incremental behaviour config pushes.
+
+Every client has a version per behaviour config, kept across reconnects of its sockets. A push is sent as a JSON
+patch against the previous version when the client acknowledged that version, otherwise (or when the patch is not
+smaller) the full config is sent. Messages sent to the client:
+
+    {"action": "update_behaviour_config", "behaviour_id": ..., "config": {...}, "version": 3}
+    {"action": "patch_behaviour_config", "behaviour_id": ..., "base_version": 3, "version": 4, "patch": [...]}
+
+Messages expected from the client:
+
+    {"action": "config_ack", "behaviour_id": ..., "version": 4}
+    {"action": "config_version_mismatch", "behaviour_id": ..., "version": <version the client has>}
+
+A mismatch is answered with a full resync of the current config, mismatches for configs that were never pushed
+to the client are ignored. Clients apply a patch operation by operation: "remove" deletes the key at the path,
+"add" and "replace" set it to the value, the empty path replaces the whole config.
+"""
+
+import hashlib
+import json
+
+
+def config_version(config: dict | None) -> str:
+    """Content based version of a config, identical configs have the same version on every instance"""
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+def _escape(key) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def diff(old, new, path: str = "") -> list[dict]:
+    """JSON patch (RFC 6902) operations turning old into new, lists are replaced as a whole"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = [{"op": "remove", "path": f"{path}/{_escape(key)}"} for key in old if key not in new]
+        for key, value in new.items():
+            key_path = f"{path}/{_escape(key)}"
+            if key not in old:
+                operations.append({"op": "add", "path": key_path, "value": value})
+            elif old[key] != value:
+                operations.extend(diff(old[key], value, key_path))
+        return operations
+    if old != new or type(old) is not type(new):
+        return [{"op": "replace", "path": path, "value": new}]
+    return []
+
+
+class BehaviourConfigState:
+    __slots__ = ("version", "acked_version", "config")
+
+    def __init__(self):
+        self.version = 0
+        self.acked_version = 0
+        self.config: dict | None = None
+
+
+class ConfigSync:
+    def __init__(self):
+        # client (hostname or username) -> behaviour_id -> state, a reconnected socket continues where the last ended
+        self._states: dict[str, dict[str, BehaviourConfigState]] = {}
+        self.full_pushes = 0
+        self.patch_pushes = 0
+
+    def _state(self, client: str, behaviour_id: str) -> BehaviourConfigState | None:
+        return self._states.get(client, {}).get(behaviour_id)
+
+    def push_message(self, client: str, behaviour_id: str, config: dict | None) -> dict:
+        """Record a new config version for the client and return the message to send, a patch when possible"""
+        state = self._states.setdefault(client, {}).setdefault(behaviour_id, BehaviourConfigState())
+        base_version, base_config = state.version, state.config
+        state.version += 1
+        state.config = config
+
+        if base_version and state.acked_version == base_version and base_config is not None and config is not None:
+            patch = diff(base_config, config)
+            if len(json.dumps(patch, default=str)) < len(json.dumps(config, default=str)):
+                self.patch_pushes += 1
+                return {
+                    "action": "patch_behaviour_config",
+                    "behaviour_id": behaviour_id,
+                    "base_version": base_version,
+                    "version": state.version,
+                    "patch": patch,
+                }
+        return self.full_message(client, behaviour_id)
+
+    def full_message(self, client: str, behaviour_id: str) -> dict | None:
+        """Full config message for a resync, None if the config was never pushed to the client"""
+        state = self._state(client, behaviour_id)
+        if state is None:
+            return None
+        self.full_pushes += 1
+        return {
+            "action": "update_behaviour_config",
+            "behaviour_id": behaviour_id,
+            "config": state.config,
+            "version": state.version,
+        }
+
+    def acknowledge(self, client: str, behaviour_id: str, version: int) -> bool:
+        state = self._state(client, behaviour_id)
+        if state is None or version != state.version:
+            return False
+        state.acked_version = version
+        return True
+
+    def forget(self, client: str):
+        """Drop the versions of a disconnected client, its next push is a full config"""
+        self._states.pop(client, None)
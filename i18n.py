@@ -2,11 +2,13 @@ import json
 import os
 from typing import Callable, Optional
 
-import yaml
 from fastapi import Request, Response
 from pydantic import BaseModel
 from starlette.middleware.base import BaseHTTPMiddleware
 
+from compute import compute_pool
+from startup import load_cached, load_yaml
+
 cwd = os.path.abspath(os.path.dirname(__file__))
 translations_file = os.path.join(cwd, "translations.yml")
 
@@ -27,9 +29,11 @@ def flatten_dict(d, parent_key="", sep="."):
     return dict(items)
 
 
-with open(translations_file, "r", encoding="utf-8") as f:
-    translations = yaml.safe_load(f)
-    translations = flatten_dict(translations)
+def load_translations(path: str) -> dict:
+    return flatten_dict(load_yaml(path))
+
+
+translations = load_cached(translations_file, load_translations)
 
 
 def translate(s, lang: str):
@@ -63,11 +67,16 @@ def parse_language(lang_header: str) -> str:
 class I18nMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next: Callable):
         response = await call_next(request)
+        # Only JSON bodies are translated, other responses (e.g. NDJSON exports) keep streaming
+        if response.headers.get("content-type") != "application/json":
+            return response
         response_body = b""
         async for chunk in response.body_iterator:
             response_body += chunk
         language = parse_language(request.headers.get("accept-language", "en"))
-        response_body = translate_response(response_body, language)
+        response_body = await compute_pool.run(
+            "translate", len(response_body), translate_response, response_body, language
+        )
         response.headers["Content-Length"] = str(len(response_body))
         return Response(
             content=response_body,
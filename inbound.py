@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from fastapi import WebSocket
+
+from admission import TokenBucket
+
+# A batch handler gets (message, websocket, username) items of one message type
+BatchHandler = Callable[[list[tuple[object, WebSocket, str]]], Awaitable[None]]
+
+
+def message_action(message) -> str | None:
+    return message.get("action") if isinstance(message, dict) else None
+
+
+class InboundPipeline:
+    """
+    Shared handling stage for messages received on the sockets of one SocketManager.
+
+    Receive loops only rate limit and queue messages, every connection has its own token bucket. A single worker
+    takes up to batch_size queued messages at once, groups them by message type and calls the handler of each
+    type once per group, so e.g. a burst of status reports from many clients is applied in one step. Messages of
+    one connection are handled in order within a message type.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        default_handler: BatchHandler,
+        handlers: dict[str | None, BatchHandler] | None = None,
+        message_type: Callable[[object], str | None] = message_action,
+        queue_size: int = 10000,
+        batch_size: int = 500,
+        rate: float = 20,
+        burst: int = 50,
+    ):
+        self.name = name
+        self.default_handler = default_handler
+        self.handlers = handlers or {}
+        self.message_type = message_type
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.rate = rate
+        self.burst = burst
+        self.queue: asyncio.Queue | None = None
+        self.worker: asyncio.Task | None = None
+        self.received = 0
+        self.limited = 0
+        self.dropped = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.errors = 0
+        self.handled: dict[str, int] = {}
+
+    def bucket(self) -> TokenBucket:
+        return TokenBucket(self.rate, self.burst)
+
+    def submit(self, bucket: TokenBucket, message, websocket: WebSocket, username: str) -> bool:
+        """Queue a received message, returns False if it was rate limited or the queue is full"""
+        self.received += 1
+        if bucket.try_acquire():
+            self.limited += 1
+            return False
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+            self.worker = asyncio.get_running_loop().create_task(self._worker())
+        try:
+            self.queue.put_nowait((message, websocket, username))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Let the receive loops that are ready run first, so that their messages join this batch
+            await asyncio.sleep(0)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.batches += 1
+            self.max_batch = max(self.max_batch, len(batch))
+
+            groups: dict[str | None, list] = {}
+            for item in batch:
+                groups.setdefault(self.message_type(item[0]), []).append(item)
+            for message_type, group in groups.items():
+                try:
+                    await self.handlers.get(message_type, self.default_handler)(group)
+                except Exception as ex:
+                    self.errors += 1
+                    logging.error(f"Inbound {self.name} failed to handle {len(group)} {message_type} messages: {ex!r}")
+                key = str(message_type)
+                self.handled[key] = self.handled.get(key, 0) + len(group)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "received": self.received,
+            "limited": self.limited,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "errors": self.errors,
+            "handled": self.handled,
+            "rate": self.rate,
+            "burst": self.burst,
+        }
+
+
+def per_message(receive_func) -> BatchHandler:
+    """Batch handler calling a receive_func(message, websocket, username) for every message"""
+
+    async def handle(batch):
+        for message, websocket, username in batch:
+            try:
+                await receive_func(message, websocket, username)
+            except Exception as ex:
+                logging.error(f"Failed to handle message from {username}: {ex!r}")
+
+    return handle
@@ -0,0 +1,178 @@
+"""
+Structured journal of exercise events (connects, disconnects, behaviour runs, configs, client reports).
+
+Events are appended as NDJSON lines to rotating files journal-<start time ns>.ndjson by a background writer
+thread, recording never blocks the event loop. Closing the journal, on shutdown or at exit, writes the queued
+events and closes the file. Every line looks like
+
+    {"ts": 1700000000.123, "event": "behaviour_run", "client": "user@domain", "behaviour_id": ..., ...}
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Iterable, Iterator
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+class EventJournal:
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024, max_files: int = 0, queue_size: int = 100000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files  # 0 keeps all files
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.recorded = 0
+        self.dropped = 0
+        self._writer: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._close_at_exit = False
+
+    def record(self, event: str, client: str | None = None, **data):
+        """Queue an event for the writer thread, the event is dropped when the queue is full"""
+        if self._writer is None:
+            self._start()
+        try:
+            self.queue.put_nowait({"ts": time.time(), "event": event, "client": client, **data})
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._writer = threading.Thread(target=self._write_loop, name="event-journal", daemon=True)
+                self._writer.start()
+                if not self._close_at_exit:
+                    # The writer is a daemon thread, events still queued at exit would be lost
+                    atexit.register(self.close)
+                    self._close_at_exit = True
+
+    def _open(self):
+        path = os.path.join(self.directory, f"journal-{time.time_ns():020d}.ndjson")
+        self._prune()
+        return open(path, "a", encoding="utf-8")
+
+    def _prune(self):
+        if not self.max_files:
+            return
+        for path in self.files()[: -self.max_files + 1 or None]:
+            try:
+                os.remove(path)
+            except OSError as ex:
+                logging.warning(f"Cannot remove old journal file {path}: {ex}")
+
+    def _write_loop(self):
+        stream = self._open()
+        while True:
+            entry = self.queue.get()
+            if entry is None:  # sentinel put by close
+                stream.close()
+                self.queue.task_done()
+                return
+            try:
+                if stream.tell() >= self.max_bytes:
+                    stream.close()
+                    stream = self._open()
+                stream.write(json.dumps(entry, separators=(",", ":"), default=_default) + "\n")
+                # Write the whole backlog before flushing, one flush per burst of events
+                if self.queue.empty():
+                    stream.flush()
+            except Exception as ex:
+                logging.error(f"Cannot write event journal entry: {ex!r}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until all recorded events are written"""
+        if self._writer is not None:
+            self.queue.join()
+
+    def close(self):
+        """Write all queued events, close the file and stop the writer, a later record starts a new file"""
+        with self._lock:
+            if self._writer is not None:
+                self.queue.put(None)
+                self._writer.join()
+                self._writer = None
+
+    def files(self) -> list[str]:
+        """Journal files, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.directory, name)
+            for name in sorted(names)
+            if name.startswith("journal-") and name.endswith(".ndjson")
+        ]
+
+    def export(
+        self,
+        since: float | None = None,
+        until: float | None = None,
+        clients: Iterable[str] | None = None,
+        events: Iterable[str] | None = None,
+    ) -> Iterator[str]:
+        """
+        Stream matching NDJSON lines, oldest first. Files are read line by line, so memory use does not
+        depend on the journal size, and files that end before `since` are skipped without reading them.
+        """
+        clients = set(clients) if clients else None
+        events = set(events) if events else None
+        files = self.files()
+        for i, path in enumerate(files):
+            if since is not None and i + 1 < len(files) and _file_start(files[i + 1]) < since:
+                continue
+            if until is not None and _file_start(path) > until:
+                return
+            with open(path, "r", encoding="utf-8") as stream:
+                for line in stream:
+                    if not line.endswith("\n"):  # being written right now
+                        break
+                    entry = json.loads(line)
+                    if since is not None and entry["ts"] < since:
+                        continue
+                    if until is not None and entry["ts"] > until:
+                        continue
+                    if clients is not None and entry.get("client") not in clients:
+                        continue
+                    if events is not None and entry["event"] not in events:
+                        continue
+                    yield line
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "files": len(self.files()),
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize(),
+        }
+
+
+def _file_start(path: str) -> float:
+    return int(os.path.basename(path)[len("journal-") : -len(".ndjson")]) / 1e9
+
+
+def read_journal(paths: Iterable[str]) -> Iterator[dict]:
+    """Read events from journal files, directories of journal files or exported NDJSON files"""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_journal(EventJournal(path).files())
+            continue
+        with open(path, "r", encoding="utf-8") as stream:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
@@ -1,16 +1,19 @@
-import configparser
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from auth import router as auth_router
+from client import config_pool, journal, state_file, take_over_clients_state, watch_clients_state
 from client import router as client_router
 from client_behaviour import router as behaviour_router
+from compute import compute_pool
 from i18n import I18nMiddleware
+from startup import format_report, load_config, phase
 
-config = configparser.ConfigParser()
-config.read("config.ini")
+config = load_config()
 logging.basicConfig(
     level=config["DEFAULT"]["log_level"],
     filename=config["DEFAULT"]["log_file"],
@@ -18,23 +21,41 @@ logging.basicConfig(
     format="%(asctime)s : %(levelname)s : %(message)s",
 )
 
-origins = config["DEFAULT"]["allowed_origins"].split("\n")
-app = FastAPI(title=config["DEFAULT"]["title"], version=config["DEFAULT"]["version"])
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-app.add_middleware(I18nMiddleware)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Spawn compute workers before the first request instead of on the first large payload
+    await asyncio.to_thread(compute_pool.start)
+    config_pool.refill()
+    # Only the server takes over saved clients, scripts importing the app must not consume the state file
+    count = take_over_clients_state(state_file)
+    logging.info(f"Took over {count} clients from {state_file}")
+    state_watcher = asyncio.create_task(watch_clients_state())
+    yield
+    state_watcher.cancel()
+    compute_pool.shutdown()
+    await asyncio.to_thread(journal.close)
+
+
+with phase("app setup"):
+    origins = config["DEFAULT"]["allowed_origins"].split("\n")
+    app = FastAPI(title=config["DEFAULT"]["title"], version=config["DEFAULT"]["version"], lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    app.add_middleware(I18nMiddleware)
 
-app.include_router(auth_router)
-app.include_router(client_router, prefix="/client", tags=["Client"])
-app.include_router(behaviour_router, prefix="/client_behaviour", tags=["Client Behaviour"])
+    app.include_router(auth_router)
+    app.include_router(client_router, prefix="/client", tags=["Client"])
+    app.include_router(behaviour_router, prefix="/client_behaviour", tags=["Client Behaviour"])
 
 logging.info(f"Started {config['DEFAULT']['title']} server {config['DEFAULT']['version']}")
+logging.info(f"Startup phases:\n{format_report()}")
 
 
 @app.middleware("http")
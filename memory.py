@@ -0,0 +1,100 @@
+"""
+Memory accounting helpers and config interning.
+
+Sizes are estimates from sys.getsizeof. deep_sizeof follows builtin containers only and counts every object once,
+so structures shared between clients are not counted twice and referenced application objects are not counted.
+"""
+
+import asyncio
+import sys
+from collections import OrderedDict
+
+CONTAINERS = (dict, list, tuple, set, frozenset)
+SCALARS = (str, bytes, int, float, bool, type(None))
+
+
+def deep_sizeof(obj, seen: set[int] | None = None) -> int:
+    seen = set() if seen is None else seen
+    if id(obj) in seen or not isinstance(obj, CONTAINERS + SCALARS):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, CONTAINERS):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def object_sizeof(obj, seen: set[int] | None = None) -> int:
+    """Size of an object with its attribute values, e.g. a WebSocket and its ASGI scope"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        size += deep_sizeof(getattr(obj, slot, None), seen)
+    return size
+
+
+def task_sizeof(task: asyncio.Task | None) -> int:
+    """Size of a task with the coroutines and frames it is currently awaiting"""
+    if task is None:
+        return 0
+    size = sys.getsizeof(task)
+    coro = task.get_coro()
+    while coro is not None:
+        size += sys.getsizeof(coro)
+        frame = getattr(coro, "cr_frame", None)
+        if frame is not None:
+            size += sys.getsizeof(frame)
+        coro = getattr(coro, "cr_await", None)
+    return size
+
+
+class ConfigInterner:
+    """
+    Shares identical config subtrees between clients. Generated configs are mostly identical template output,
+    interned configs reference one dict per distinct subtree. Interned structures must not be modified.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, object] = OrderedDict()  # structure key -> shared structure
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        if isinstance(value, dict):
+            value = {sys.intern(key) if isinstance(key, str) else key: self.intern(item) for key, item in value.items()}
+            key = (dict, tuple((key, self._item_key(item)) for key, item in value.items()))
+        elif isinstance(value, list):
+            value = [self.intern(item) for item in value]
+            key = (list, tuple(self._item_key(item) for item in value))
+        else:
+            return value
+
+        shared = self._entries.get(key)
+        if shared is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return shared
+        self.misses += 1
+        self._entries[key] = value
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _item_key(item):
+        # Interned containers are identified by identity, they stay alive as long as the structures containing them.
+        # 1, 1.0 and True are equal, the type keeps them apart.
+        return id(item) if isinstance(item, (dict, list)) else (type(item), item)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
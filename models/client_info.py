@@ -0,0 +1,19 @@
+from pydantic import BaseModel
+
+from models.client_config import ClientConfig
+
+
+class ClientInfo(BaseModel):
+    username: str
+    hostname: str
+    current_behaviour: str | None
+    client_config: ClientConfig
+
+
+class ClientsInfoResponse(BaseModel):
+    clients_info: list[ClientInfo]
+
+
+def encode_clients_info(clients: list[dict]) -> bytes:
+    """Validate and encode a GET /client/ listing, runs in a compute worker for large listings"""
+    return ClientsInfoResponse.model_validate({"clients_info": clients}).model_dump_json().encode()
@@ -1,23 +1,156 @@
-import yaml
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from types import MappingProxyType
+from typing import Iterator, Mapping
+
+
+def _unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1].replace("''", "'")
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return json.loads(value)
+    # Plain scalars end at an inline comment
+    return value.split(" #", 1)[0].rstrip()
+
+
+def iter_user_credentials(credentials_filepath: str) -> Iterator[tuple[str, str, str]]:
+    """
+    Stream (key, username, password) tuples from the credentials file line by line.
+
+    The file is a YAML mapping of credential lists, e.g. `o365_credentials:` followed by
+    `  - user@domain:{plain}password` items, so it is parsed without loading the whole document.
+    """
+    with open(credentials_filepath, "r", encoding="utf-8") as stream:
+        key = None
+        for line in stream:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            if stripped.startswith("-"):
+                username, sep, password = _unquote(stripped[1:].strip()).partition(":{plain}")
+                if key and sep:
+                    yield key, username, password
+            elif not line[0].isspace():
+                key = stripped.split(":", 1)[0].strip()
 
 
 def parse_user_credentials(credentials_filepath: str) -> dict:
     """
     Parse user credentials and return as a dict with keys matching the YAML structure.
     """
-    with open(credentials_filepath, "r") as stream:
-        yaml_data = yaml.safe_load(stream)
+    result = {}
+    for key, username, password in iter_user_credentials(credentials_filepath):
+        result.setdefault(key, []).append({"username": username, "password": password})
+    return result
 
-        result = {}
-        for key, users in yaml_data.items():
-            if not users:
-                continue
-            result[key] = [
-                {
-                    "username": user.split(":{plain}")[0],
-                    "password": user.split(":{plain}")[1],
-                }
-                for user in users
-            ]
-
-        return result
+
+def parse_credentials_index(credentials_filepath: str) -> dict[str, dict[str, str]]:
+    """
+    Parse user credentials into a username -> password index per credentials key.
+    """
+    index: dict[str, dict[str, str]] = {}
+    for key, username, password in iter_user_credentials(credentials_filepath):
+        index.setdefault(key, {})[sys.intern(username)] = password
+    return index
+
+
+class CredentialStore:
+    """
+    Username -> password index over the credentials file, reloaded when the file changes.
+
+    Reloads build a new index and swap it in with a single assignment, readers never see a partial index. Lookups
+    only start the change check in a worker thread and keep answering from the current index while it runs.
+    """
+
+    def __init__(self, credentials_filepath: str, check_interval: float = 2.0):
+        self.credentials_filepath = credentials_filepath
+        self.check_interval = check_interval
+        self.stats: dict = {}
+        self._index: dict[str, dict[str, str]] = {}
+        self._mtime_ns: int | None = None
+        self._last_check = 0.0
+        self._reload_future: asyncio.Future | None = None
+
+    def load(self) -> dict:
+        """Parse the credentials file, swap in the new index and return parse statistics"""
+        mtime_ns = os.stat(self.credentials_filepath).st_mtime_ns
+        start = time.perf_counter()
+        # Never cached on disk, that would be a second copy of every password outliving changes of the file
+        index = parse_credentials_index(self.credentials_filepath)
+        parse_seconds = time.perf_counter() - start
+
+        self._index = index
+        self._mtime_ns = mtime_ns
+        self._last_check = time.monotonic()
+        self.stats = {
+            "loaded_at": time.time(),
+            "parse_seconds": parse_seconds,
+            "entries": {key: len(users) for key, users in index.items()},
+            "index_bytes": self._index_size(index),
+        }
+        return self.stats
+
+    def reload_if_changed(self) -> bool:
+        """Reload if the file changed since the last load, stat the file at most once per check_interval"""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        try:
+            if os.stat(self.credentials_filepath).st_mtime_ns == self._mtime_ns:
+                return False
+        except OSError as ex:
+            logging.warning(f"Cannot stat credentials file {self.credentials_filepath}: {ex}")
+            return False
+        stats = self.load()
+        logging.info(
+            f"Reloaded changed credentials file {self.credentials_filepath}: {stats['entries']} "
+            f"in {stats['parse_seconds'] * 1000:.1f} ms, {stats['index_bytes']} bytes"
+        )
+        return True
+
+    def reload_in_background(self):
+        """Run reload_if_changed in the default executor of the running loop, one check at a time"""
+        if time.monotonic() - self._last_check < self.check_interval:
+            return
+        if self._reload_future is not None and not self._reload_future.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.reload_if_changed()
+            return
+        self._reload_future = loop.run_in_executor(None, self._reload_quietly)
+
+    def _reload_quietly(self):
+        try:
+            self.reload_if_changed()
+        except Exception as ex:
+            logging.error(f"Cannot reload credentials file {self.credentials_filepath}: {ex!r}")
+
+    def view(self, key: str) -> Mapping[str, str]:
+        return MappingProxyType(self._index.get(key, {}))
+
+    @property
+    def o365_credentials(self) -> Mapping[str, str]:
+        return self.view("o365_credentials")
+
+    @property
+    def domain_credentials(self) -> Mapping[str, str]:
+        return self.view("domain_credentials")
+
+    def get_password(self, key: str, username: str) -> str | None:
+        self.reload_in_background()
+        return self._index.get(key, {}).get(username)
+
+    @staticmethod
+    def _index_size(index: dict[str, dict[str, str]]) -> int:
+        size = sys.getsizeof(index)
+        for key, users in index.items():
+            size += sys.getsizeof(key) + sys.getsizeof(users)
+            size += sum(sys.getsizeof(username) + sys.getsizeof(password) for username, password in users.items())
+        return size
@@ -0,0 +1,183 @@
+"""
+On-demand diagnostics of a running server: a sampling profiler over all threads and a snapshot of asyncio tasks.
+
+The profiler thread reads the current stack of every other thread with sys._current_frames every interval, so the
+profiled code is not instrumented and only pays for the GIL the sampler holds while walking the stacks. Stacks are
+returned in the collapsed format of flamegraph.pl and speedscope, or as a speedscope sampled profile.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Task origins by the module of the innermost application coroutine the task is running
+ORIGIN_GROUPS = {
+    "sockets": "socket_handlers",
+    "inbound": "socket_handlers",
+    "i18n": "middleware",
+    "main": "middleware",
+    "admission": "middleware",
+    "client_behaviour": "behaviour_dispatch",
+}
+
+Frame = tuple[str, str, int]  # qualified name, file, line
+
+
+_short_paths: dict[str, str] = {}
+
+
+def _short_path(filename: str) -> str:
+    path = _short_paths.get(filename)
+    if path is None:
+        path = filename
+        for prefix in sorted([APP_DIR] + sys.path, key=len, reverse=True):
+            if prefix and filename.startswith(prefix + os.sep):
+                path = filename[len(prefix) + 1 :]
+                break
+        _short_paths[filename] = path
+    return path
+
+
+def _qualname(code) -> str:
+    return getattr(code, "co_qualname", code.co_name)
+
+
+class Profile:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Counter[tuple[str, tuple[Frame, ...]]] = Counter()  # (thread name, root first frames) -> samples
+        self.samples = 0
+        self.duration = 0.0
+
+    def threads(self) -> dict[str, int]:
+        threads = Counter()
+        for (thread, _), count in self.stacks.items():
+            threads[thread] += count
+        return dict(threads.most_common())
+
+    def collapsed(self) -> str:
+        lines = []
+        for (thread, frames), count in self.stacks.most_common():
+            names = [thread] + [f"{name} ({path}:{line})" for name, path, line in frames]
+            lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines)
+
+    def speedscope(self) -> dict:
+        """Speedscope file with one sampled profile per thread, identical stacks are merged into one weighted sample"""
+        frame_index: dict[Frame, int] = {}
+        profiles: dict[str, dict] = {}
+        for (thread, frames), count in self.stacks.items():
+            profile = profiles.get(thread)
+            if profile is None:
+                profile = profiles[thread] = {
+                    "type": "sampled",
+                    "name": thread,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": self.duration,
+                    "samples": [],
+                    "weights": [],
+                }
+            profile["samples"].append([frame_index.setdefault(frame, len(frame_index)) for frame in frames])
+            profile["weights"].append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {
+                "frames": [{"name": name, "file": path, "line": line} for name, path, line in frame_index],
+            },
+            "profiles": list(profiles.values()),
+            "name": f"{self.duration:.1f} s profile",
+            "exporter": "user_automation_server",
+        }
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float, interval: float) -> Profile | None:
+        """Sample all other threads for the given time, blocks the calling thread. None if a profile is running."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(seconds, interval)
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _sample(seconds: float, interval: float) -> Profile:
+        profile = Profile(interval)
+        own_id = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append((_qualname(code), _short_path(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                frames.reverse()
+                profile.stacks[(names.get(thread_id, str(thread_id)), tuple(frames))] += 1
+            profile.samples += 1
+            time.sleep(interval)
+        profile.duration = time.perf_counter() - start
+        return profile
+
+
+def _coroutine_chain(task: asyncio.Task) -> list:
+    """Code objects of the coroutines a task is awaiting, outermost first"""
+    codes = []
+    coro = task.get_coro()
+    while coro is not None:
+        code = getattr(coro, "cr_code", None) or getattr(coro, "ag_code", None)
+        if code is None:
+            break
+        codes.append(code)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "ag_await", None)
+    return codes
+
+
+def task_origin(task: asyncio.Task) -> tuple[str, str]:
+    """Origin group and coroutine of a task, from the innermost coroutine defined in the application"""
+    codes = _coroutine_chain(task)
+    for code in reversed(codes):
+        if os.path.dirname(os.path.abspath(code.co_filename)) == APP_DIR:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            return ORIGIN_GROUPS.get(module, module), f"{module}.{_qualname(code)}"
+    if not codes:
+        return "other", task.get_name()
+    # Library tasks, e.g. the websocket protocol tasks of the server, by the module they were started in
+    module = os.path.splitext(_short_path(codes[0].co_filename))[0].replace(os.sep, ".")
+    return "other", f"{module}.{_qualname(codes[0])}"
+
+
+def task_snapshot() -> dict:
+    """Tasks of the running event loop grouped by origin, must be called on the loop"""
+    tasks = asyncio.all_tasks()
+    origins: dict[str, Counter] = {}
+    for task in tasks:
+        group, coroutine = task_origin(task)
+        origins.setdefault(group, Counter())[coroutine] += 1
+    return {
+        "tasks": len(tasks),
+        "origins": {
+            group: {"tasks": sum(coroutines.values()), "coroutines": dict(coroutines.most_common())}
+            for group, coroutines in sorted(origins.items(), key=lambda item: -sum(item[1].values()))
+        },
+    }
+
+
+profiler = SamplingProfiler()
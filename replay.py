@@ -0,0 +1,184 @@
+"""
+Replay a recorded event journal against a running server, e.g. for load testing a local instance.
+
+Events are sent at their recorded pace scaled by --speed (0 sends as fast as possible). Events of one client
+are replayed in order, different clients run concurrently. Client passwords are looked up in the credentials
+file, the journal does not contain them. Client disconnects need an exercise control (white team) login.
+
+    python replay.py journal/                                   # directory of journal files
+    python replay.py export.ndjson --url http://127.0.0.1:8001 --speed 10 --admin white01 --admin-password ...
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+
+import httpx
+import websockets
+
+from journal import read_journal
+from parse_credentials import parse_credentials_index
+
+
+class Replayer:
+    def __init__(self, base_url: str, passwords: dict[str, str], admin_token: str | None = None):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = self.base_url.replace("http", "ws", 1)
+        self.passwords = passwords
+        self.http = httpx.AsyncClient(base_url=self.base_url, timeout=30)
+        self.tokens: dict[str, str] = {}
+        self.admin_headers = {"Authorization": f"Bearer {admin_token}"} if admin_token else {}
+        self.sockets: dict[tuple[str, str], list] = {}
+        self.config_versions: dict[tuple[str, str], int] = {}  # latest config version received by a client
+        self.pending: dict[str, asyncio.Task] = {}
+        self.readers: set[asyncio.Task] = set()
+        self.replayed = Counter()
+        self.failed = Counter()
+
+    def submit(self, event: dict):
+        """Replay the event after the previous event of the same client"""
+        client = event.get("client") or ""
+        self.pending[client] = asyncio.create_task(self._after(self.pending.get(client), event))
+
+    async def _after(self, previous: asyncio.Task | None, event: dict):
+        if previous is not None:
+            await previous
+        try:
+            handled = await self.handle(event)
+        except Exception as ex:
+            logging.warning(f"Replaying {event['event']} of {event.get('client')} failed: {ex!r}")
+            handled = False
+        (self.replayed if handled else self.failed)[event["event"]] += 1
+
+    async def handle(self, event: dict) -> bool:
+        client = event.get("client")
+        match event["event"]:
+            case "client_connect":
+                password = self.passwords.get(client)
+                if password is None:
+                    return False
+                response = await self.http.post(
+                    "/client/connect", data={"username": client, "password": password, "hostname": event["hostname"]}
+                )
+                if response.status_code != 200:
+                    return False
+                self.tokens[client] = response.json()["access_token"]
+            case "client_disconnect":
+                response = await self.http.delete(
+                    "/client/disconnect", params={"hostname": event["hostname"]}, headers=self.admin_headers
+                )
+                return response.status_code == 200
+            case "socket_connect":
+                if client not in self.tokens:
+                    return False
+                websocket = await websockets.connect(f"{self.ws_url}/client/{event['endpoint']}")
+                await websocket.send(self.tokens[client])
+                self.sockets.setdefault((client, event["endpoint"]), []).append(websocket)
+                reader = asyncio.create_task(self._read(client, websocket))
+                self.readers.add(reader)
+                reader.add_done_callback(self.readers.discard)
+            case "socket_disconnect":
+                sockets = self.sockets.get((client, event["endpoint"]))
+                if not sockets:
+                    return False
+                await sockets.pop(0).close()
+            case "behaviour_run" | "behaviour_config":
+                path = "/run" if event["event"] == "behaviour_run" else "/update_config"
+                params = {"client_username": client, "behaviour_id": event["behaviour_id"]}
+                response = await self.http.post(f"/client_behaviour{path}", params=params, json=event.get("config"))
+                return response.status_code == 200 and response.json()["status"] == "success"
+            case "behaviour_state":
+                # Run ids of the replay differ from the recorded ones, the state applies to the current run
+                message = {"behaviour_id": event["behaviour_id"], "state": event["state"], "detail": event["detail"]}
+                return await self._send(client, "client_status_socket", message)
+            case "config_ack" | "config_version_mismatch":
+                version = event["version"]
+                if event["event"] == "config_ack":
+                    version = self.config_versions.get((client, event["behaviour_id"]), version)
+                message = {"action": event["event"], "behaviour_id": event["behaviour_id"], "version": version}
+                return await self._send(client, "client_socket", message)
+            case _:
+                return False
+        return True
+
+    async def _send(self, client: str, endpoint: str, message: dict) -> bool:
+        sockets = self.sockets.get((client, endpoint))
+        if not sockets:
+            return False
+        await sockets[-1].send(json.dumps(message))
+        return True
+
+    async def _read(self, client: str, websocket):
+        """Drain server messages and remember the config versions pushed to the client"""
+        try:
+            async for frame in websocket:
+                message = json.loads(frame)
+                if message.get("action") in ("update_behaviour_config", "patch_behaviour_config"):
+                    self.config_versions[(client, message["behaviour_id"])] = message["version"]
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        await asyncio.gather(*self.pending.values())
+        for sockets in self.sockets.values():
+            for websocket in sockets:
+                await websocket.close()
+        await self.http.aclose()
+
+
+async def login(base_url: str, username: str, password: str) -> str:
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        response = await http.post("/login", data={"username": username, "password": password})
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+
+async def replay(
+    paths: list[str], base_url: str, speed: float, passwords: dict[str, str], admin: tuple[str, str] | None = None
+) -> Replayer:
+    admin_token = await login(base_url, *admin) if admin else None
+    replayer = Replayer(base_url, passwords, admin_token)
+    start = time.monotonic()
+    first_ts = None
+    for event in read_journal(paths):
+        if first_ts is None:
+            first_ts = event["ts"]
+        if speed:
+            delay = (event["ts"] - first_ts) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        replayer.submit(event)
+    await replayer.close()
+    return replayer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded event journal against a server")
+    parser.add_argument("paths", nargs="+", help="journal directories, journal files or exported NDJSON files")
+    parser.add_argument("--url", default="http://127.0.0.1:8001")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale, 0 replays without delays")
+    parser.add_argument("--credentials", default="user_credentials.yml")
+    parser.add_argument("--admin", help="white team user replaying client disconnects")
+    parser.add_argument("--admin-password", default="")
+    args = parser.parse_args()
+
+    passwords = {}
+    for users in parse_credentials_index(args.credentials).values():
+        passwords.update(users)
+
+    start = time.perf_counter()
+    admin = (args.admin, args.admin_password) if args.admin else None
+    replayer = asyncio.run(replay(args.paths, args.url, args.speed, passwords, admin))
+    elapsed = time.perf_counter() - start
+
+    total = sum(replayer.replayed.values()) + sum(replayer.failed.values())
+    print(f"Replayed {total} events in {elapsed:.1f} s ({total / max(elapsed, 1e-9):.0f} events/s)")
+    for event in sorted(replayer.replayed.keys() | replayer.failed.keys()):
+        print(f"  {event:<26} {replayer.replayed[event]:>8} ok {replayer.failed[event]:>8} failed")
+
+
+if __name__ == "__main__":
+    main()
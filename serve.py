@@ -0,0 +1,79 @@
+"""
+Run the server on a SO_REUSEPORT socket with graceful drain on SIGTERM/SIGINT.
+
+A new instance can bind the same port while the old one is still running. On the first signal the old
+instance stops listening, saves clients_info, sends the messages still queued for its sockets and asks connected
+clients to reconnect after a randomized delay, so they reconnect to the new instance spread over time. The new
+instance takes over the saved clients as soon as the state file appears and removes it. A second signal exits
+immediately.
+
+    python serve.py --host 0.0.0.0 --port 8001
+
+In a multi-instance deployment (see cluster.py) every instance is started with its name from [cluster] instances:
+
+    python serve.py --port 8001 --instance a
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+
+import uvicorn
+
+
+class DrainingServer(uvicorn.Server):
+    def __init__(self, config: uvicorn.Config):
+        super().__init__(config)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.draining = False
+
+    async def startup(self, sockets=None):
+        self.loop = asyncio.get_running_loop()
+        await super().startup(sockets)
+
+    def handle_exit(self, sig, frame):
+        if self.draining or self.loop is None:
+            return super().handle_exit(sig, frame)
+        self.draining = True
+        self.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.drain(sig, frame)))
+
+    async def drain(self, sig, frame):
+        from client import drain_clients
+
+        # Stop listening first so that new connections go to the other instance sharing the port
+        for server in self.servers:
+            server.close()
+        try:
+            await drain_clients()
+        except Exception as ex:
+            logging.error(f"Drain failed: {ex}")
+        super().handle_exit(sig, frame)
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the User Automation server with graceful drain")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--instance", help="name of this instance in a multi-instance deployment")
+    args = parser.parse_args()
+    if args.instance:
+        os.environ["INSTANCE_NAME"] = args.instance
+
+    server = DrainingServer(uvicorn.Config("main:app"))
+    server.run(sockets=[bind_socket(args.host, args.port)])
+
+
+if __name__ == "__main__":
+    main()
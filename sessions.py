@@ -0,0 +1,129 @@
+import heapq
+import secrets
+import time
+
+
+class Session:
+    __slots__ = ("jti", "username", "hostname", "issued_at", "expires_at")
+
+    def __init__(self, jti: str, username: str, hostname: str | None, issued_at: float, expires_at: int):
+        self.jti = jti
+        self.username = username
+        self.hostname = hostname
+        self.issued_at = issued_at
+        self.expires_at = expires_at
+
+    def dict(self) -> dict:
+        return {
+            "jti": self.jti,
+            "username": self.username,
+            "hostname": self.hostname,
+            "issued_at": self.issued_at,
+            "expires_at": self.expires_at,
+        }
+
+
+class SessionRegistry:
+    """
+    Issued tokens by token ID (jti), the set of revoked token IDs and a not-before cutoff per hostname.
+
+    Revocation checks are a set lookup and a cutoff comparison. Only the latest session of a hostname is kept, a host
+    that reconnects over and over does not grow the registry. Disconnecting a host sets its cutoff, which rejects
+    every token issued to it before, including tokens issued by a previous instance. Entries are kept only until the
+    tokens they concern expire, expiry heaps purge them as time goes on.
+    """
+
+    def __init__(self, token_lifetime: int):
+        self.token_lifetime = token_lifetime
+        self.sessions: dict[str, Session] = {}
+        self.hostname_sessions: dict[str, str] = {}  # hostname -> jti of its latest session
+        self.revoked: dict[str, int] = {}  # jti -> expiry
+        self.not_before: dict[str, float] = {}  # hostname -> tokens issued before are revoked
+        self._expiry: list[tuple[int, str]] = []
+        self._not_before_expiry: list[tuple[float, str]] = []
+
+    def issue(self, username: str, hostname: str | None, issued_at: float, expires_at: int) -> Session:
+        self.purge_expired()
+        session = Session(secrets.token_hex(8), username, hostname, issued_at, expires_at)
+        self.sessions[session.jti] = session
+        if hostname is not None:
+            # The previous token stays valid until it expires or the host is disconnected, it is not tracked anymore
+            previous = self.hostname_sessions.get(hostname)
+            if previous is not None:
+                self.sessions.pop(previous, None)
+            self.hostname_sessions[hostname] = session.jti
+        heapq.heappush(self._expiry, (expires_at, session.jti))
+        self._compact_expiry()
+        return session
+
+    def is_revoked(self, jti: str | None, hostname: str | None = None, issued_at: float = 0) -> bool:
+        self.purge_expired()
+        if hostname is not None and issued_at < self.not_before.get(hostname, 0):
+            return True
+        return jti in self.revoked
+
+    def revoke(self, jti: str, expires_at: int | None = None) -> bool:
+        """Revoke a token, expires_at is needed for tokens this instance did not issue"""
+        if jti in self.revoked:
+            return False
+        session = self.sessions.pop(jti, None)
+        if session is not None:
+            expires_at = session.expires_at
+            self._discard_hostname_session(session)
+        elif expires_at is None:
+            return False
+        else:
+            heapq.heappush(self._expiry, (expires_at, jti))
+        self.revoked[jti] = expires_at
+        return True
+
+    def revoke_hostname(self, hostname: str, cutoff: float | None = None) -> list[str]:
+        """
+        Revoke all tokens issued to a hostname before the cutoff, now by default.
+        Returns the revoked token IDs this instance knows about.
+        """
+        cutoff = time.time() if cutoff is None else cutoff
+        if cutoff > self.not_before.get(hostname, 0):
+            self.not_before[hostname] = cutoff
+            heapq.heappush(self._not_before_expiry, (cutoff + self.token_lifetime, hostname))
+        jti = self.hostname_sessions.get(hostname)
+        session = self.sessions.get(jti) if jti is not None else None
+        if session is None or session.issued_at >= cutoff:
+            return []
+        self.revoke(jti)
+        return [jti]
+
+    def _discard_hostname_session(self, session: Session):
+        if session.hostname is not None and self.hostname_sessions.get(session.hostname) == session.jti:
+            del self.hostname_sessions[session.hostname]
+
+    def _compact_expiry(self):
+        """Drop heap entries of sessions replaced by a newer session of the same host"""
+        live = len(self.sessions) + len(self.revoked)
+        if len(self._expiry) > 2 * live + 1024:
+            self._expiry = [entry for entry in self._expiry if entry[1] in self.sessions or entry[1] in self.revoked]
+            heapq.heapify(self._expiry)
+
+    def purge_expired(self, now: float | None = None):
+        now = time.time() if now is None else now
+        while self._expiry and self._expiry[0][0] <= now:
+            _, jti = heapq.heappop(self._expiry)
+            session = self.sessions.pop(jti, None)
+            if session is not None:
+                self._discard_hostname_session(session)
+            self.revoked.pop(jti, None)
+        while self._not_before_expiry and self._not_before_expiry[0][0] <= now:
+            _, hostname = heapq.heappop(self._not_before_expiry)
+            # Every token issued before the cutoff has expired
+            cutoff = self.not_before.get(hostname)
+            if cutoff is not None and cutoff + self.token_lifetime <= now:
+                del self.not_before[hostname]
+
+    def stats(self) -> dict:
+        self.purge_expired()
+        return {
+            "sessions": len(self.sessions),
+            "hostnames": len(self.hostname_sessions),
+            "revoked": len(self.revoked),
+            "disconnected_hostnames": len(self.not_before),
+        }
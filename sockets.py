@@ -1,11 +1,20 @@
 import asyncio
 import json
 import logging
+import random
+import sys
+import threading
+import time
+import zlib
 from datetime import datetime
 
 from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
 
-from auth import current_user
+import ws_protocol
+from admission import AdmissionController
+from auth import decode_token, sessions, users
+from inbound import InboundPipeline
+from memory import deep_sizeof, object_sizeof, task_sizeof
 from utils import WSMessage
 
 
@@ -14,6 +23,167 @@ class CustomJSONEncoder(json.JSONEncoder):
         return obj.isoformat() if isinstance(obj, datetime) else super().default(obj)
 
 
+class Connection:
+    """Per-socket state, one compact record shared by the shard and manager indexes"""
+
+    __slots__ = ("username", "hostname", "jti", "issued_at", "shard", "task", "connected_at", "bucket")
+
+    def __init__(self, username: str, hostname: str | None, jti: str | None, issued_at: float, shard: "SocketShard"):
+        self.username = sys.intern(username)
+        self.hostname = sys.intern(hostname) if hostname else None
+        self.jti = jti
+        self.issued_at = issued_at  # of the token, tokens issued before the host was disconnected are revoked
+        self.shard = shard
+        self.task = asyncio.current_task()
+        self.connected_at = time.time()
+        self.bucket = None  # inbound message rate limit
+
+
+class SocketShard:
+    """
+    Connections of one team or hash bucket with their own indexes and send queue.
+
+    The queue worker encodes and sends messages in order, either as a task on the server event loop or on
+    its own event loop in a separate thread. Indexes are only modified on the server event loop.
+    """
+
+    def __init__(self, name: str, manager: "SocketManager", queue_size: int, threaded: bool):
+        self.name = name
+        self.manager = manager
+        self.sockets: dict[WebSocket, Connection] = {}
+        self.user_sockets: dict[str, set[WebSocket]] = {}
+        self.queue_size = queue_size
+        self.threaded = threaded
+        self.queue: asyncio.Queue | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None  # loop running the queue worker
+        self.sent = 0
+        self.dropped = 0
+        self.stalled = 0
+        self.pending = 0  # messages queued or on their way to the queue of a threaded shard
+        self.pending_lock = threading.Lock()
+
+    def add(self, websocket: WebSocket, connection: Connection):
+        self.sockets[websocket] = connection
+        self.user_sockets.setdefault(connection.username, set()).add(websocket)
+
+    def remove(self, websocket: WebSocket):
+        connection = self.sockets.pop(websocket, None)
+        if connection is None:
+            return
+        user_sockets = self.user_sockets.get(connection.username)
+        if user_sockets is not None:
+            user_sockets.discard(websocket)
+            if not user_sockets:
+                del self.user_sockets[connection.username]
+
+    def _start(self):
+        server_loop = asyncio.get_running_loop()
+        if not self.threaded:
+            self.loop = server_loop
+            self.queue = asyncio.Queue(self.queue_size)
+            self.worker = server_loop.create_task(self._worker(server_loop))
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(
+            target=self._run_thread, args=(server_loop, ready), name=f"socket-shard-{self.name}", daemon=True
+        ).start()
+        ready.wait()
+
+    def _run_thread(self, server_loop: asyncio.AbstractEventLoop, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue(self.queue_size)
+        self.worker = self.loop.create_task(self._worker(server_loop))
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def enqueue(self, websocket: WebSocket, message: dict, on_sent=None) -> bool:
+        """
+        Queue a message for the socket, must be called from the server event loop. Returns False if the message was
+        dropped because the send queue is full. on_sent is called on the server event loop once the message was
+        written to the socket.
+        """
+        if self.loop is None:
+            self._start()
+        if not self.threaded:
+            return self._put(websocket, message, on_sent)
+        # The queue is filled on the shard thread, count the messages on their way to it as well
+        with self.pending_lock:
+            if self.pending >= self.queue_size:
+                return self._dropped(websocket)
+            self.pending += 1
+        self.loop.call_soon_threadsafe(self._put, websocket, message, on_sent)
+        return True
+
+    def _put(self, websocket: WebSocket, message: dict, on_sent=None) -> bool:
+        try:
+            self.queue.put_nowait((websocket, message, on_sent))
+            return True
+        except asyncio.QueueFull:
+            return self._dropped(websocket)
+
+    def _dropped(self, websocket: WebSocket) -> bool:
+        self.dropped += 1
+        logging.warning(f"Socket shard {self.name} send queue is full, dropped message for {websocket}")
+        return False
+
+    async def _worker(self, server_loop: asyncio.AbstractEventLoop):
+        while True:
+            websocket, message, on_sent = await self.queue.get()
+            try:
+                if websocket not in self.sockets:
+                    # Closed or stalled meanwhile, its remaining messages are discarded
+                    continue
+                frame = self.manager.encode(websocket, message)
+                # A client that stops reading must not hold up the other sockets of the shard
+                send = asyncio.wait_for(self.manager._send_frame(websocket, frame), self.manager.send_timeout)
+                if self.threaded:
+                    await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(send, server_loop))
+                else:
+                    await send
+                self.sent += 1
+                if on_sent:
+                    server_loop.call_soon_threadsafe(on_sent)
+            except asyncio.TimeoutError:
+                self.stalled += 1
+                logging.warning(f"Socket {websocket} did not accept a message within {self.manager.send_timeout} s")
+                if self.threaded:
+                    server_loop.call_soon_threadsafe(self.manager._close_stalled, websocket)
+                else:
+                    self.manager._close_stalled(websocket)
+            except (RuntimeError, WebSocketDisconnect) as ex:
+                logging.warning(f"Socket {websocket} is closed, cannot send message: {ex!r}")
+                server_loop.call_soon_threadsafe(self.manager._unregister, websocket)
+            except Exception as ex:
+                logging.error(f"Socket shard {self.name} failed to send message: {ex!r}")
+            finally:
+                self.queue.task_done()
+                if self.threaded:
+                    with self.pending_lock:
+                        self.pending -= 1
+
+    async def flush(self):
+        """Wait until the queued messages are sent, must be called from the server event loop"""
+        if self.queue is None:
+            return
+        if self.threaded:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.queue.join(), self.loop))
+        else:
+            await self.queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "sockets": len(self.sockets),
+            "users": len(self.user_sockets),
+            "queued": self.queue.qsize() if self.queue else 0,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "stalled": self.stalled,
+            "threaded": self.threaded,
+        }
+
+
 class SocketManager:
     def __init__(
         self,
@@ -22,63 +192,337 @@ class SocketManager:
         is_json: bool,
         connect_func=None,
         receive_func=None,
+        disconnect_func=None,
+        admission: AdmissionController | None = None,
+        handshake_timeout: float | None = None,
+        compression_threshold: int = 4096,
+        max_message_size: int = 1024 * 1024,
+        hash_shards: int = 1,
+        queue_size: int = 1000,
+        threaded_shards: bool = False,
+        send_timeout: float = 5.0,
+        inbound: InboundPipeline | None = None,
     ):
-        self.connected_sockets: dict[WebSocket, str] = {}  # store connected websockets for event updates
+        # Connected websockets are stored in shards, operators by team and clients by username hash
+        self.shards: dict[str, SocketShard] = {}
+        self.connections: dict[WebSocket, Connection] = {}
+        self.hash_shards = hash_shards
+        self.queue_size = queue_size
+        self.threaded_shards = threaded_shards
+        self.send_timeout = send_timeout
+        self.closing: set[asyncio.Task] = set()
         self.router = router
         self.is_json = is_json
+        self.admission = admission
+        self.draining = False
+        self.reconnect_range = (1.0, 5.0)
+        self.binary_sockets: set[WebSocket] = set()  # sockets that negotiated the binary protocol
+        self.compression_threshold = compression_threshold
+        self.max_message_size = max_message_size
+        self.disconnect_func = disconnect_func
+        # Received messages are handled by the pipeline when given, otherwise inline by receive_func
+        self.inbound = inbound
+        # Sockets by token ID, revoked sessions are closed immediately
+        self.session_sockets: dict[str, set[WebSocket]] = {}
 
         @router.websocket(endpoint)
         async def websocket_endpoint(websocket: WebSocket):
-            await websocket.accept()
-            token = await websocket.receive_text()  # receive auth token as first message
+            subprotocol = ws_protocol.negotiate(websocket.scope.get("subprotocols", [])) if self.is_json else None
+            await websocket.accept(subprotocol=subprotocol)
+            if subprotocol == ws_protocol.BINARY_SUBPROTOCOL:
+                self.binary_sockets.add(websocket)
             try:
-                username = await current_user(token)
-            except HTTPException:
-                logging.warning(f"Socket {endpoint} attempted connect with invalid token {token}")
-                await self._update_status("Invalid token", websocket)
-                await websocket.close()
+                await self._serve_socket(endpoint, websocket, connect_func, receive_func, handshake_timeout)
+            finally:
+                self.binary_sockets.discard(websocket)
+
+    async def _serve_socket(self, endpoint: str, websocket: WebSocket, connect_func, receive_func, handshake_timeout):
+        if self.draining:
+            await self._send_reconnect(random.uniform(*self.reconnect_range), websocket)
+            return
+        if self.admission:
+            retry_after = self.admission.try_enter()
+            if retry_after:
+                await self._send_retry(retry_after, websocket)
                 return
-            logging.info(f"Socket {endpoint} connected for user {username}")
-            await self._update_status("Connected to socket", websocket)
-            self.connected_sockets[websocket] = username
-            if connect_func:
-                await connect_func(websocket, username)
+        try:
+            username = await self._handshake(endpoint, websocket, connect_func, handshake_timeout)
+        finally:
+            if self.admission:
+                self.admission.leave()
+        if username is None:
+            return
 
-            # receive message from client
-            try:
-                while True:
-                    if receive_func:
-                        if self.is_json:
-                            try:
-                                received_message = await websocket.receive_json()
-                            except json.JSONDecodeError:
-                                logging.warning(f"Socket {endpoint} for user {username} received invalid JSON message")
-                                await self._update_status("Invalid message JSON", websocket)
-                                continue
-                        else:
-                            received_message = await websocket.receive_text()
-                        logging.info(f"Socket {endpoint} for user {username} received message {received_message}")
-                        await receive_func(received_message, websocket, username)
+        # receive message from client
+        connection = self.connections[websocket]
+        if self.inbound:
+            connection.bucket = self.inbound.bucket()
+        try:
+            while True:
+                if sessions.is_revoked(connection.jti, connection.hostname, connection.issued_at):
+                    logging.warning(f"Socket {endpoint} for user {username} uses a revoked token, closing")
+                    await self._close_revoked(websocket)
+                    break
+                if self.inbound or receive_func:
+                    if self.is_json:
+                        try:
+                            received_message = await self._receive_json(websocket)
+                        except ValueError:  # json.JSONDecodeError or ws_protocol.DecodeError
+                            logging.warning(f"Socket {endpoint} for user {username} received invalid JSON message")
+                            await self._update_status("Invalid message JSON", websocket)
+                            continue
                     else:
-                        # Just keep the connection alive without custom processing
-                        received_message = await websocket.receive_json()
-                        logging.info(f"Socket {endpoint} for user {username} received message {received_message}")
-
-            except (WebSocketDisconnect, asyncio.CancelledError):
-                logging.info(f"Socket {endpoint} for user {username} disconnected normally")
-            except RuntimeError as ex:
-                logging.info(f"Socket {endpoint} for user {username} disconnected with RuntimeError: {ex}")
-            except Exception as ex:
-                logging.error(f"Socket {endpoint} for user {username} encountered unexpected error: {ex}")
-            finally:
-                if websocket in self.connected_sockets:
-                    del self.connected_sockets[websocket]
-                logging.info(f"Socket {endpoint} for user {username} cleaned up")
+                        received_message = await websocket.receive_text()
+                    logging.debug(f"Socket {endpoint} for user {username} received message {received_message}")
+                    if self.inbound:
+                        if not self.inbound.submit(connection.bucket, received_message, websocket, username):
+                            logging.debug(f"Socket {endpoint} for user {username} message was rate limited or dropped")
+                    else:
+                        await receive_func(received_message, websocket, username)
+                else:
+                    # Just keep the connection alive without custom processing
+                    received_message = await self._receive_json(websocket)
+                    logging.debug(f"Socket {endpoint} for user {username} received message {received_message}")
 
-    async def send_to_all(self, message):
+        except (WebSocketDisconnect, asyncio.CancelledError):
+            logging.info(f"Socket {endpoint} for user {username} disconnected normally")
+        except RuntimeError as ex:
+            logging.info(f"Socket {endpoint} for user {username} disconnected with RuntimeError: {ex}")
+        except Exception as ex:
+            logging.error(f"Socket {endpoint} for user {username} encountered unexpected error: {ex}")
+        finally:
+            self._unregister(websocket)
+            if self.disconnect_func:
+                await self.disconnect_func(websocket, username)
+            logging.info(f"Socket {endpoint} for user {username} cleaned up")
+
+    async def _handshake(self, endpoint: str, websocket: WebSocket, connect_func, timeout: float | None):
+        """Authenticate the socket and register it, return the username or None if the socket was closed"""
+        try:
+            # receive auth token as first message
+            token = await asyncio.wait_for(websocket.receive_text(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Socket {endpoint} did not send auth token within {timeout} seconds")
+            await websocket.close()
+            return None
+        except WebSocketDisconnect:
+            logging.info(f"Socket {endpoint} disconnected before sending auth token")
+            return None
+        try:
+            claims = decode_token(token)
+        except HTTPException:
+            logging.warning(f"Socket {endpoint} attempted connect with invalid token {token}")
+            await self._update_status("Invalid token", websocket)
+            await websocket.close()
+            return None
+        username = claims["sub"]
+        logging.info(f"Socket {endpoint} connected for user {username}")
+        await self._update_status("Connected to socket", websocket)
+        self._register(websocket, username, claims.get("hostname"), claims.get("jti"), claims.get("iat", 0))
+        if connect_func:
+            await connect_func(websocket, username)
+        return username
+
+    async def _send_retry(self, retry_after: float, websocket: WebSocket):
+        """Reject the socket with a retry hint and close code 1013 (try again later)"""
+        if self.is_json:
+            await self.send_json(websocket, WSMessage.retry(retry_after).dict())
+        else:
+            await websocket.send_text(f"Server busy, retry after {retry_after:.1f} seconds")
+        await websocket.close(code=1013)
+
+    async def _send_reconnect(self, reconnect_after: float, websocket: WebSocket, timeout: float | None = None):
+        """Ask the client to reconnect after a delay and close with code 1012 (service restart)"""
+        try:
+            if self.is_json:
+                message = self.send_json(websocket, WSMessage.reconnect(reconnect_after).dict())
+            else:
+                message = websocket.send_text(f"Server restarting, reconnect after {reconnect_after:.1f} seconds")
+            await asyncio.wait_for(message, timeout)
+            await websocket.close(code=1012)
+        except (RuntimeError, WebSocketDisconnect, asyncio.TimeoutError) as ex:
+            logging.warning(f"Socket {websocket} could not be drained: {ex!r}")
+
+    async def drain(self, reconnect_min: float, reconnect_max: float, timeout: float = 5.0) -> int:
+        """
+        Stop accepting sockets, send the queued messages, tell every connected client to reconnect after a randomized
+        delay and close it. Returns the number of drained sockets.
+        """
+        self.draining = True
+        self.reconnect_range = (reconnect_min, reconnect_max)
+        await self.flush(timeout)
         sockets = list(self.connected_sockets.keys())
-        for ws in sockets:
-            await self._send_message(message, ws)
+        await asyncio.gather(
+            *(self._send_reconnect(random.uniform(reconnect_min, reconnect_max), ws, timeout) for ws in sockets)
+        )
+        return len(sockets)
+
+    async def flush(self, timeout: float | None = None) -> bool:
+        """Wait until the send queues of all shards are empty, returns False if they were not within the timeout"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(shard.flush() for shard in self.shards.values())), timeout)
+            return True
+        except asyncio.TimeoutError:
+            queued = sum(shard.queue.qsize() for shard in self.shards.values() if shard.queue)
+            logging.warning(f"Socket send queues were not flushed within {timeout} seconds, {queued} messages left")
+            return False
+
+    def shard_key(self, username: str) -> str:
+        user = users.get(username)
+        if user is not None:
+            return user["team"]
+        return f"clients-{zlib.crc32(username.encode()) % self.hash_shards}"
+
+    def shard_for(self, username: str) -> SocketShard:
+        key = self.shard_key(username)
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = self.shards[key] = SocketShard(key, self, self.queue_size, self.threaded_shards)
+        return shard
+
+    def _register(
+        self,
+        websocket: WebSocket,
+        username: str,
+        hostname: str | None = None,
+        jti: str | None = None,
+        issued_at: float = 0,
+    ):
+        connection = Connection(username, hostname, jti, issued_at, self.shard_for(username))
+        connection.shard.add(websocket, connection)
+        self.connections[websocket] = connection
+        if jti is not None:
+            self.session_sockets.setdefault(jti, set()).add(websocket)
+
+    def _unregister(self, websocket: WebSocket):
+        connection = self.connections.pop(websocket, None)
+        if connection is None:
+            return
+        connection.shard.remove(websocket)
+        if connection.jti is not None:
+            websockets = self.session_sockets.get(connection.jti)
+            if websockets is not None:
+                websockets.discard(websocket)
+                if not websockets:
+                    del self.session_sockets[connection.jti]
+
+    async def _close_revoked(self, websocket: WebSocket):
+        """Close a socket whose token was revoked with code 1008 (policy violation)"""
+        try:
+            await self._update_status("Token revoked", websocket)
+            await websocket.close(code=1008)
+        except (RuntimeError, WebSocketDisconnect) as ex:
+            logging.warning(f"Socket {websocket} with revoked token could not be closed: {ex!r}")
+
+    def _close_stalled(self, websocket: WebSocket):
+        """Stop sending to a socket that does not read its messages and close it with code 1013 (try again later)"""
+        self._unregister(websocket)
+        task = asyncio.ensure_future(self._close_quietly(websocket, 1013))
+        # The loop keeps weak references to tasks only
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def _close_quietly(self, websocket: WebSocket, code: int):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), self.send_timeout)
+        except (RuntimeError, WebSocketDisconnect, asyncio.TimeoutError) as ex:
+            logging.warning(f"Socket {websocket} could not be closed: {ex!r}")
+
+    async def close_sessions(self, jtis: list[str]) -> int:
+        """Close the sockets authenticated with any of the token IDs, returns the number of closed sockets"""
+        websockets = [websocket for jti in jtis for websocket in self.session_sockets.get(jti, ())]
+        await asyncio.gather(*(self._close_revoked(websocket) for websocket in websockets))
+        return len(websockets)
+
+    async def close_hostname(self, hostname: str) -> int:
+        """Close the sockets of a disconnected host, also those using tokens issued by a previous instance"""
+        websockets = [
+            websocket for websocket, connection in self.connections.items() if connection.hostname == hostname
+        ]
+        await asyncio.gather(*(self._close_revoked(websocket) for websocket in websockets))
+        return len(websockets)
+
+    @property
+    def connected_sockets(self) -> dict[WebSocket, str]:
+        """All connected websockets across shards, prefer the shard indexes for lookups"""
+        return {websocket: connection.username for websocket, connection in self.connections.items()}
+
+    def sockets_for_user(self, username: str) -> list[WebSocket]:
+        shard = self.shards.get(self.shard_key(username))
+        return list(shard.user_sockets.get(username, ())) if shard else []
+
+    def client_id(self, websocket: WebSocket) -> str | None:
+        """Hostname of the client behind the socket, the username for sockets without one, None if not connected"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return None
+        return connection.hostname or connection.username
+
+    def queue_json(self, websocket: WebSocket, message: dict, on_sent=None) -> bool:
+        """
+        Send a message through the send queue of the socket's shard, messages to one socket keep their order.
+        Returns False if the socket is not connected or the message was dropped because the queue is full.
+        """
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return False
+        return connection.shard.enqueue(websocket, message, on_sent)
+
+    def shard_stats(self) -> list[dict]:
+        return [shard.stats() for shard in self.shards.values()]
+
+    def memory_stats(self) -> dict:
+        """Estimated memory of the connections: records, indexes, WebSocket objects and their tasks, in bytes"""
+        seen: set[int] = set()
+        records = sum(object_sizeof(connection, seen) for connection in self.connections.values())
+        indexes = [self.connections, self.session_sockets, self.binary_sockets]
+        for shard in self.shards.values():
+            indexes += [shard.sockets, shard.user_sockets]
+        index_bytes = sum(deep_sizeof(index, seen) for index in indexes)
+        websockets = sum(object_sizeof(websocket, seen) for websocket in self.connections)
+        tasks = sum(task_sizeof(connection.task) for connection in self.connections.values())
+        total = records + index_bytes + websockets + tasks
+        count = len(self.connections)
+        return {
+            "connections": count,
+            "records": records,
+            "indexes": index_bytes,
+            "websockets": websockets,
+            "tasks": tasks,
+            "total": total,
+            "per_connection": total // count if count else 0,
+        }
+
+    def encode(self, websocket: WebSocket, message: dict) -> str | bytes:
+        """Encode a message as negotiated by the socket, JSON text unless it chose the binary protocol"""
+        if websocket in self.binary_sockets:
+            return ws_protocol.encode(message, self.compression_threshold)
+        return json.dumps(message, cls=CustomJSONEncoder)
+
+    async def _send_frame(self, websocket: WebSocket, frame: str | bytes):
+        if isinstance(frame, bytes):
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame)
+
+    async def send_json(self, websocket: WebSocket, message: dict):
+        """Send a message directly, bypassing the shard send queue"""
+        await self._send_frame(websocket, self.encode(websocket, message))
+
+    async def _receive_json(self, websocket: WebSocket):
+        if websocket in self.binary_sockets:
+            return ws_protocol.decode(await websocket.receive_bytes(), self.max_message_size)
+        return await websocket.receive_json()
+
+    async def send_to_all(self, message):
+        if not self.is_json:
+            for ws in list(self.connected_sockets):
+                await self._send_message(message, ws)
+            return
+        wrapped = WSMessage.object_message(message).dict()
+        for shard in self.shards.values():
+            for ws in list(shard.sockets):
+                shard.enqueue(ws, wrapped)
 
     async def send_to_user(self, message, websocket: WebSocket):
         await self._send_message(message, websocket)
@@ -86,7 +530,7 @@ class SocketManager:
     async def _update_status(self, status: str, websocket: WebSocket):
         if self.is_json:
             status_msg = WSMessage.status(status)
-            await websocket.send_json(status_msg.dict())
+            await self.send_json(websocket, status_msg.dict())
         else:
             await websocket.send_text(status)
 
@@ -94,16 +538,11 @@ class SocketManager:
         try:
             if self.is_json:
                 if isinstance(message, object):
-                    await ws.send_text(
-                        json.dumps(
-                            WSMessage.object_message(message).dict(),
-                            cls=CustomJSONEncoder,
-                        )
-                    )
+                    await self.send_json(ws, WSMessage.object_message(message).dict())
                 else:
-                    await ws.send_text(json.dumps(message, cls=CustomJSONEncoder))
+                    await self.send_json(ws, message)
             else:
                 await ws.send_text(message)
         except RuntimeError:
             logging.warning(f"Socket {ws} is closed, cannot send message")
-            del self.connected_sockets[ws]
+            self._unregister(ws)
@@ -0,0 +1,172 @@
+"""
+Startup configuration loader.
+
+Every configuration file is parsed at most once per process, parsed YAML results are cached on disk
+keyed by file mtime/size (falling back to a content hash) so that restarts and new workers skip parsing.
+Files holding secrets, like the client credentials, are not cached.
+
+Run `python -m startup` to print a startup-time report broken down by import and initialization phase.
+"""
+
+import configparser
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+cwd = os.path.abspath(os.path.dirname(__file__))
+logger = logging.getLogger(__name__)
+cache_dir = os.getenv("STARTUP_CACHE_DIR", os.path.join(cwd, ".startup_cache"))
+
+# Initialization phase name -> seconds spent, in the order the phases were first entered
+phase_timings: dict[str, float] = {}
+
+
+@contextmanager
+def phase(name: str):
+    """Record the time spent inside the block under the given phase name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_timings[name] = phase_timings.get(name, 0.0) + time.perf_counter() - start
+
+
+@functools.cache
+def load_config() -> configparser.ConfigParser:
+    """Read config.ini once per process"""
+    with phase("config.ini"):
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+    return config
+
+
+def load_yaml(path: str) -> Any:
+    import yaml
+
+    with open(path, "r", encoding="utf-8") as stream:
+        return yaml.safe_load(stream)
+
+
+def _cache_file(path: str, parser: Callable[[str], Any]) -> str:
+    key = f"{os.path.abspath(path)}:{parser.__module__}.{parser.__qualname__}:{sys.version_info[:2]}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pickle")
+
+
+def _read_cache(cache_file: str) -> dict | None:
+    try:
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+
+
+def _write_cache(cache_file: str, entry: dict):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Atomic so that concurrently starting workers never see a partial cache file
+        os.replace(tmp_path, cache_file)
+    except OSError as ex:
+        logger.warning(f"Could not write startup cache {cache_file}: {ex}")
+
+
+_loaded: dict[tuple[str, Callable], Any] = {}
+
+
+def load_cached(path: str, parser: Callable[[str], Any] = load_yaml) -> Any:
+    """
+    Return parser(path), parsing the file at most once per process and reusing the on-disk cache
+    while the file is unchanged.
+    """
+    if (path, parser) in _loaded:
+        return _loaded[(path, parser)]
+
+    start = time.perf_counter()
+    source = "cached"
+    stat = os.stat(path)
+    cache_file = _cache_file(path, parser)
+    entry = _read_cache(cache_file)
+
+    if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        result = entry["result"]
+    else:
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if entry and entry["sha256"] == digest:
+            # Touched but not modified, refresh the stat key only
+            result = entry["result"]
+        else:
+            source = "parsed"
+            result = parser(path)
+        _write_cache(
+            cache_file, {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest, "result": result}
+        )
+
+    # No logging here, this runs at import time before main.py configures logging
+    phase_timings[f"{os.path.basename(path)} ({source})"] = time.perf_counter() - start
+    _loaded[(path, parser)] = result
+    return result
+
+
+def drop_cached(path: str, *parsers: Callable[[str], Any]):
+    """Remove the on-disk cache of a file that must not be cached, e.g. written by an older version"""
+    for parser in parsers:
+        try:
+            os.remove(_cache_file(path, parser))
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            logger.warning(f"Could not remove startup cache of {path}: {ex}")
+
+
+def format_report() -> str:
+    total = sum(phase_timings.values())
+    lines = [f"{'phase':<40} {'ms':>10}"]
+    for name, seconds in phase_timings.items():
+        lines.append(f"{name:<40} {seconds * 1000:>10.2f}")
+    lines.append(f"{'total':<40} {total * 1000:>10.2f}")
+    return "\n".join(lines)
+
+
+def import_report(module: str = "main") -> str:
+    """Import module in a fresh interpreter and break import and initialization time down by phase"""
+    code = f"import json, startup; import {module}; print(json.dumps(startup.phase_timings))"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=os.getcwd()
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # Lines look like "import time:  <self us> | <cumulative us> |   package.module", sum self time per package
+    imports: dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s+(\S+)", line)
+        if match:
+            package = match.group(2).split(".")[0]
+            imports[package] = imports.get(package, 0) + int(match.group(1))
+    phases = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    lines = [f"{'import (self time per package)':<40} {'ms':>10}"]
+    for name, us in sorted(imports.items(), key=lambda item: item[1], reverse=True)[:20]:
+        lines.append(f"{name:<40} {us / 1000:>10.2f}")
+    lines.append("")
+    lines.append(f"{'initialization phase':<40} {'ms':>10}")
+    for name, seconds in phases.items():
+        lines.append(f"{name:<40} {seconds * 1000:>10.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print(import_report(sys.argv[1] if len(sys.argv) > 1 else "main"))
@@ -14,3 +14,11 @@ class WSMessage(BaseModel):
     @classmethod
     def object_message(cls, obj: Any) -> "WSMessage":
         return cls(type="object", data=obj)
+
+    @classmethod
+    def retry(cls, retry_after: float) -> "WSMessage":
+        return cls(type="retry", data={"retry_after": retry_after})
+
+    @classmethod
+    def reconnect(cls, reconnect_after: float) -> "WSMessage":
+        return cls(type="reconnect", data={"reconnect_after": reconnect_after})
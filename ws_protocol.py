@@ -0,0 +1,120 @@
+"""
+Compact binary encoding for socket traffic, negotiated with the WebSocket subprotocol header.
+
+Clients that offer the "uas.msgpack.v1" subprotocol exchange binary frames, everything else keeps the JSON text
+protocol. A binary frame is one flag byte followed by a MessagePack map, zlib compressed when the flag is
+FLAG_ZLIB. Well known keys and values are replaced by short codes:
+
+    {"action": "run_behaviour", "behaviour_id": "procrastination", "config": None}
+    -> {"a": 1, "b": "procrastination", "c": None}
+"""
+
+import zlib
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:  # binary protocol is optional, JSON keeps working without msgpack
+    msgpack = None
+
+JSON_SUBPROTOCOL = "uas.json"
+BINARY_SUBPROTOCOL = "uas.msgpack.v1"
+
+FLAG_RAW = 0
+FLAG_ZLIB = 1
+
+FIELD_CODES = {
+    "action": "a",
+    "behaviour_id": "b",
+    "config": "c",
+    "type": "t",
+    "data": "d",
+    "version": "v",
+    "base_version": "bv",
+    "patch": "p",
+    "run_id": "r",
+    "state": "s",
+}
+# Values of these fields are replaced by integer codes
+VALUE_CODES = {
+    "action": {
+        "run_behaviour": 1,
+        "update_behaviour_config": 2,
+        "patch_behaviour_config": 3,
+        "config_ack": 4,
+        "config_version_mismatch": 5,
+    },
+    "type": {"status": 1, "object": 2, "retry": 3, "reconnect": 4},
+}
+
+FIELD_NAMES = {code: field for field, code in FIELD_CODES.items()}
+VALUE_NAMES = {field: {code: value for value, code in codes.items()} for field, codes in VALUE_CODES.items()}
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def supported_subprotocols() -> list[str]:
+    return [BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL] if msgpack else [JSON_SUBPROTOCOL]
+
+
+def negotiate(offered: list[str]) -> str | None:
+    """Pick the subprotocol to accept, the client's preference order wins"""
+    supported = supported_subprotocols()
+    for subprotocol in offered:
+        if subprotocol in supported:
+            return subprotocol
+    return None
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+
+def encode(message: dict, compression_threshold: int) -> bytes:
+    compact = {}
+    for field, value in message.items():
+        if field in VALUE_CODES:
+            value = VALUE_CODES[field].get(value, value)
+        compact[FIELD_CODES.get(field, field)] = value
+    payload = msgpack.packb(compact, default=_default)
+    if len(payload) >= compression_threshold:
+        return bytes([FLAG_ZLIB]) + zlib.compress(payload)
+    return bytes([FLAG_RAW]) + payload
+
+
+def decode(frame: bytes, max_size: int = 1024 * 1024) -> dict:
+    """Decode a binary frame, frames larger than max_size bytes, compressed or decompressed, are rejected"""
+    try:
+        if frame[0] == FLAG_ZLIB:
+            # Decompress at most max_size bytes, so that a small compressed frame cannot expand without limit
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(frame[1:], max_size)
+            if decompressor.unconsumed_tail:
+                raise DecodeError(f"Binary message is larger than {max_size} bytes")
+            if not decompressor.eof:
+                raise DecodeError("Binary message is truncated")
+        elif frame[0] == FLAG_RAW:
+            payload = frame[1:]
+        else:
+            raise DecodeError(f"Unknown frame flag {frame[0]}")
+        if len(payload) > max_size:
+            raise DecodeError(f"Binary message is larger than {max_size} bytes")
+        compact = msgpack.unpackb(payload)
+    except DecodeError:
+        raise
+    except (IndexError, ValueError, zlib.error, msgpack.UnpackException) as ex:
+        raise DecodeError(f"Invalid binary message: {ex}") from ex
+    if not isinstance(compact, dict):
+        raise DecodeError("Binary message is not a map")
+
+    message = {}
+    for code, value in compact.items():
+        field = FIELD_NAMES.get(code, code)
+        if field in VALUE_NAMES:
+            value = VALUE_NAMES[field].get(value, value)
+        message[field] = value
+    return message